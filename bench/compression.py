@@ -0,0 +1,112 @@
+"""Measures the bandwidth and CPU that compression saves and costs for a
+broadcast-heavy connection (a stream of single messages) and a backlog-heavy
+one (a stream of 100 message backlog replies).
+
+Compared: no compression, WebSocket permessage-deflate with and without
+context takeover (tornado keeps the context unless the client declines),
+and the TCP zlib stream, each at zlib levels 1 and 6.
+
+    python bench/compression.py [frames]
+"""
+import os
+import sys
+import time
+import uuid
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from compression import ZlibStream
+import wire
+
+HANDLES = ["brendan", "alice", "bob", "carol", "dave"]
+
+
+def message(i):
+    handle = HANDLES[i % len(HANDLES)]
+    return {
+        "id": "5463c5c5e1382318d8a5%04x" % (i % 65536),
+        "from": {
+            "id": uuid.uuid5(uuid.NAMESPACE_DNS, handle).hex,
+            "handle": handle,
+            "name": handle.title()
+        },
+        "ts": 1415824837000 + i * 1500,
+        "target": "#robust",
+        "body": "Chat traffic is highly repetitive, this is message number %d." % i,
+        "type": "message"
+    }
+
+
+def backlog(i):
+    return {
+        "type": "backlog",
+        "target": "#robust",
+        "count": 100,
+        "messages": [message(i * 100 + j) for j in range(100)],
+        "more": True,
+        "next": None
+    }
+
+
+class Deflate:
+    """permessage-deflate (RFC 7692) as tornado's compressor does it."""
+
+    def __init__(self, level, takeover):
+        self.level = level
+        self.takeover = takeover
+        self._c = self._new()
+
+    def _new(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def compress(self, data):
+        c = self._c if self.takeover else self._new()
+        out = c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH)
+        return out[:-4]  # The empty block every sync flush ends with.
+
+
+class Plain:
+    def compress(self, data):
+        return data
+
+
+def schemes():
+    yield "none", Plain
+    for level in (1, 6):
+        yield "ws deflate, level %d" % level, lambda level=level: Deflate(level, True)
+        yield "ws deflate, no takeover, level %d" % level, lambda level=level: Deflate(level, False)
+        yield "tcp zlib stream, level %d" % level, lambda level=level: ZlibStream(level)
+
+
+def run(frames, make):
+    compressor = make()
+    raw = written = 0
+
+    start = time.process_time()
+    for data in frames:
+        raw += len(data)
+        written += len(compressor.compress(data))
+    cpu = time.process_time() - start
+
+    return raw, written, cpu
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    workloads = [
+        ("broadcasts", [wire.JSON.encode(message(i)) for i in range(n)]),
+        ("backlogs", [wire.JSON.encode(backlog(i)) for i in range(n // 100)]),
+    ]
+
+    for name, frames in workloads:
+        print("%s: %d frames" % (name, len(frames)))
+        for scheme, make in schemes():
+            raw, written, cpu = run(frames, make)
+            print("  %-34s %9d bytes %5.1f%%  %6.1fus/frame" % (
+                scheme, written, written / raw * 100, cpu / len(frames) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
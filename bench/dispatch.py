@@ -0,0 +1,59 @@
+"""Measures the cost of decoding, dispatching and validating each kind of
+incoming message, before its handler runs, against resolving the handler
+with getattr as SocketMessageHandler.parse used to.
+
+    python bench/dispatch.py [iterations]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from exceptions import MessageError
+from messages import COMMANDS, SocketMessageHandler
+import wire
+
+MESSAGES = [
+    {"type": "ping"},
+    {"type": "message", "target": "#robust", "body": "Hello, world!"},
+    {"type": "join", "target": ["#robust", "#python", "#tornado"]},
+    {"type": "backlog", "target": "#robust", "count": 50},
+    {"type": "user", "id": "9c6fd3df3bf247548cc873c95608b421"},
+    {"type": "users", "ids": ["9c6fd3df3bf247548cc873c95608b421"] * 20},
+    {"type": "join", "target": ["#robust", 1]},
+]
+
+
+def dispatch(obj):
+    validate, method = COMMANDS[obj['type']]
+    try:
+        validate(obj)
+    except MessageError:
+        pass
+    return method
+
+
+def lookup(obj):
+    type_ = obj.get('type', "_")
+    if type_.startswith("_"):
+        raise MessageError("No valid type specified.")
+    return getattr(SocketMessageHandler, type_, None)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    print("%-60s %8s %8s %8s" % ("message", "decode", "getattr", "schema"))
+    for message in MESSAGES:
+        line = wire.JSON.encode(message)
+        decode = timeit.timeit(lambda: wire.JSON.decode(line), number=n) / n
+        old = timeit.timeit(lambda: lookup(message), number=n) / n
+        new = timeit.timeit(lambda: dispatch(message), number=n) / n
+
+        print("%-60s %6.0fns %6.0fns %6.0fns" % (
+            line.decode('utf-8').strip()[:60], decode * 1e9, old * 1e9, new * 1e9))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Compares field access and JSON views of the schema-compiled User against
+the dict-backed class it replaced, kept here as DictUser.
+
+    python bench/entities.py [iterations]
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from entities import User
+
+
+class DictUser:
+    """User as it was: the schema is rebuilt on every access."""
+
+    @classmethod
+    def public(self):
+        return ['id', 'name', 'handle', 'timezone', 'bio',
+                'display_picture', 'display_picture_large',
+                'location', 'is_server_admin',
+                'twitter_uid']
+
+    @classmethod
+    def required(cls):
+        return ['name', 'handle']
+
+    @classmethod
+    def defaults(cls):
+        return {
+            "location": "",
+            "bio": "",
+            "timezone": 0,
+            "display_picture": None,
+            "display_picture_large": None,
+            "twitter_uid": None,
+            "facebook_uid": None,
+            "github_uid": None,
+            "is_server_admin": False,
+            "channels": []
+        }
+
+    def _to_json(self):
+        return self.record
+
+    def __getitem__(self, key):
+        if key in self.defaults() or key in self.required() or key == "_id":
+            return self._data[key]
+        raise KeyError
+
+    def __setitem__(self, key, value):
+        if key in self.defaults() or key in self.required():
+            self._data[key] = value
+            return value
+        raise KeyError
+
+    def __init__(self, collection, record, authorised=True):
+        self._data = record
+        self._collection = collection
+        self._authorised = authorised
+
+    @property
+    def record(self):
+        if not self._authorised:
+            o = {}
+            for p in self.public():
+                if p == 'id':
+                    o[p] = self._data['_id'].hex
+                else:
+                    o[p] = self._data[p]
+            return o
+        else:
+            o = self._data.copy()
+            o['id'] = o['_id'].hex
+            del o['_id']
+            return o
+
+
+def document():
+    o = User.defaults()
+    o.update({
+        "_id": uuid.uuid4(),
+        "name": "Brendan Molloy",
+        "handle": "brendan",
+        "twitter_uid": "12345678",
+        "channels": ["#robust", "#python", "#tornado"]
+    })
+    return o
+
+
+def per_instance(cls, n=10000):
+    documents = [document() for _ in range(n)]
+    tracemalloc.start()
+    users = [cls(None, d) for d in documents]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(users)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    for cls in (DictUser, User):
+        user = cls(None, document())
+        public = cls(None, document(), False)
+
+        cases = [
+            ("user['handle']", lambda: user['handle']),
+            ("user['bio'] = ...", lambda: user.__setitem__('bio', "")),
+            ("public _to_json", public._to_json),
+            ("authorised _to_json", user._to_json),
+        ]
+
+        print("%s (%.0f bytes per instance)" % (cls.__name__, per_instance(cls)))
+        for name, f in cases:
+            elapsed = timeit.timeit(f, number=n)
+            print("  %-22s %6.0fns" % (name, elapsed / n * 1e9))
+
+
+if __name__ == "__main__":
+    main()
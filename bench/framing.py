@@ -0,0 +1,66 @@
+"""Benchmarks LineFramer against the BytesIO framing it replaced, feeding
+chunks that pipeline many request lines at once.
+
+    python bench/framing.py
+"""
+from io import BytesIO
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from framing import LineFramer
+
+LINE = b'{"type":"message","target":"#robust","body":"' + b'x' * 80 + b'"}'
+
+
+class BytesIOFramer:
+    """The framing TCPServer.data_received used to do inline."""
+
+    def __init__(self):
+        self._buf = BytesIO()
+
+    def feed(self, data):
+        lines = []
+        i = data.find(b'\n')
+        while i > -1:
+            self._buf.write(data[:i])
+            lines.append(self._buf.getvalue())
+            self._buf = BytesIO()
+            data = data[i+1:]
+            i = data.find(b'\n')
+        self._buf.write(data)
+        return lines
+
+
+def chunks(lines, size):
+    stream = (LINE + b'\n') * lines
+    return [stream[i:i + size] for i in range(0, len(stream), size)]
+
+
+def run(framer_cls, data):
+    framer = framer_cls()
+    n = 0
+    for chunk in data:
+        n += len(framer.feed(chunk))
+    return n
+
+
+def main():
+    print("%8s %10s %12s %12s" % ("lines", "chunk", "BytesIO", "LineFramer"))
+    for lines, size in [(100, 64 * 1024), (1000, 64 * 1024),
+                        (10000, 256 * 1024), (10000, 1024 * 1024)]:
+        data = chunks(lines, size)
+        assert run(BytesIOFramer, data) == run(LineFramer, data) == lines
+
+        number = max(1, 20000 // lines)
+        old = timeit.timeit(lambda: run(BytesIOFramer, data), number=number)
+        new = timeit.timeit(lambda: run(LineFramer, data), number=number)
+        print("%8d %10d %10.3fms %10.3fms" % (
+            lines, size, old / number * 1000, new / number * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Compares heartbeat bookkeeping for 100k simulated idle connections: the
+per-line `call_later` re-arming TCPServer used to do against recording a
+timestamp and sweeping a HeartbeatWheel.
+
+    python bench/heartbeat.py [connections]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from heartbeat import HeartbeatWheel
+
+LINES = 5
+
+
+class TimerConnection:
+    """The old scheme: every received line cancels and re-creates a timer."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.handle = None
+
+    def update_heartbeat_future(self):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = self.loop.call_later(180, self.heartbeat)
+
+    def heartbeat(self):
+        pass
+
+
+class WheelConnection:
+    def __init__(self, clock):
+        self.clock = clock
+        self.last_activity = clock()
+        self.pings = 0
+
+    def heartbeat(self):
+        self.pings += 1
+
+    def heartbeat_failed(self):
+        pass
+
+
+def bench_timers(n):
+    loop = asyncio.new_event_loop()
+    conns = [TimerConnection(loop) for _ in range(n)]
+
+    start = time.perf_counter()
+    for _ in range(LINES):
+        for conn in conns:
+            conn.update_heartbeat_future()
+    elapsed = time.perf_counter() - start
+
+    # Cancelled handles linger in the heap until they come due.
+    heap = len(loop._scheduled)
+    for conn in conns:
+        conn.handle.cancel()
+    loop.close()
+    return elapsed, heap
+
+
+def bench_wheel(n):
+    now = [0.0]
+    clock = lambda: now[0]
+    wheel = HeartbeatWheel(clock=clock)
+    conns = [WheelConnection(clock) for _ in range(n)]
+    for conn in conns:
+        wheel.add(conn)
+
+    start = time.perf_counter()
+    for i in range(LINES):
+        now[0] = float(i)
+        for conn in conns:
+            conn.last_activity = now[0]
+    touch = time.perf_counter() - start
+
+    # One idle sweep, then the sweep that pings every connection.
+    now[0] = 100.0
+    start = time.perf_counter()
+    wheel.sweep()
+    idle = time.perf_counter() - start
+
+    now[0] = LINES + wheel.idle_wait
+    start = time.perf_counter()
+    wheel.sweep()
+    busy = time.perf_counter() - start
+
+    assert sum(conn.pings for conn in conns) == n
+    return touch, idle, busy
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    elapsed, heap = bench_timers(n)
+    print("call_later: %d lines on %d connections in %.1fms, %d timers in heap" % (
+        LINES * n, n, elapsed * 1000, heap))
+
+    touch, idle, busy = bench_wheel(n)
+    print("wheel:      %d lines on %d connections in %.1fms, %d timers in heap" % (
+        LINES * n, n, touch * 1000, 1))
+    print("wheel:      sweep %.3fms with nothing due, %.1fms pinging all %d" % (
+        idle * 1000, busy * 1000, n))
+
+
+if __name__ == "__main__":
+    main()
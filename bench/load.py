@@ -0,0 +1,470 @@
+"""Load test of a robust server over both transports.
+
+Starts server.py against the mongod at --mongo with the `test_auth`
+property set, signs --clients clients in over TLS TCP and WebSocket, and
+has each send a weighted mix of requests, one at a time, for --duration
+seconds. Throughput, p50/p99 latency per request type, broadcast delivery
+latency, server RSS per connection and server CPU are printed and saved as
+JSON, so runs before and after a change can be compared:
+
+    python bench/load.py --clients=500 --duration=30 --output=before.json
+    python bench/load.py --clients=500 --duration=30 --output=after.json
+    python bench/load.py --compare=before.json,after.json
+
+Use a scratch database, as the load users and their messages are left in
+it. A certificate for the TCP listener is made with `openssl` unless
+--certfile and --keyfile are given. Server memory and CPU are read from
+/proc, so only Linux reports them. With --external, an already running
+server is used instead; pass its --pid for memory and CPU.
+"""
+from collections import deque
+from tornado.options import define, options
+from tornado.platform.asyncio import AsyncIOMainLoop
+
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import tornado.concurrent
+import tornado.gen
+import tornado.iostream
+import tornado.options
+import tornado.tcpclient
+import tornado.websocket
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+define('clients', default=200, type=int, help='Clients to connect.')
+define('ws_share', default=0.5, type=float,
+       help='Share of the clients using WebSocket rather than TCP.')
+define('duration', default=30.0, type=float, help='Seconds of load.')
+define('channels', default=10, type=int, help='Channels the clients spread over.')
+define('mix', default='message:60,backlog:10,join:10,user:20',
+       help='Weights of the request types sent.')
+define('think', default=0.0, type=float,
+       help='Seconds each client waits between a reply and its next request.')
+define('seed', default=1, type=int, help='Seed of the request mix.')
+define('host', default='127.0.0.1')
+define('http_port', default=18888, type=int)
+define('tcp_port', default=18889, type=int)
+define('mongo', default='127.0.0.1:27017', help='MongoDB host:port of the server.')
+define('server_options', default='', help='Extra options passed to server.py.')
+define('certfile', help='Certificate of the TCP listener.')
+define('keyfile', help='Key of the TCP listener.')
+define('external', default=False, type=bool, help='Use a server already running.')
+define('pid', default=None, type=int, help='Process id of an --external server.')
+define('output', default=None, help='File to save the results to, as JSON.')
+define('compare', default=None, help='Two result files to compare, comma separated.')
+
+MAX_LINE = 64 * 1024 * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarise(values):
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50),
+        "p99_ms": percentile(values, 99),
+        "max_ms": max(values) if values else None
+    }
+
+
+def rss_bytes(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def cpu_seconds(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime, fields 14 and 15 of stat(5).
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}  # type -> [ms]
+        self.errors = {}  # subtype -> count
+        self.broadcasts = []  # ms from a message's ts to its delivery
+        # The least seen of that for the replies to our own messages. The
+        # server's ts isn't quite our clock, so broadcasts are measured
+        # against this rather than against zero.
+        self.base = None
+
+    def reply(self, type_, ms, reply):
+        self.latencies.setdefault(type_, []).append(ms)
+
+        if reply.get('type') == "error":
+            subtype = reply.get('subtype')
+            self.errors[subtype] = self.errors.get(subtype, 0) + 1
+        elif type_ == "message":
+            since = time.time() * 1000 - reply['ts']
+            self.base = since if self.base is None else min(self.base, since)
+
+    def broadcast(self, since):
+        self.broadcasts.append(since)
+
+    def broadcast_latencies(self):
+        base = self.base or 0
+        return [max(0, since - base) for since in self.broadcasts]
+
+
+class Client:
+    """One connection sending requests one at a time and matching replies
+    to them in order, as the server replies in order. Messages other
+    clients broadcast are counted separately."""
+
+    def __init__(self, index, rng, stats):
+        self.handle = "load%d" % index
+        self.channel = "#load%d" % (index % options.channels)
+        self.rng = rng
+        self.stats = stats
+        self.user_id = None
+        self.closed = False
+        self._pending = deque()  # futures of replies
+
+    @tornado.gen.coroutine
+    def start(self):
+        yield self.connect()
+        self._read()
+
+        welcome = yield self._wait()
+        assert welcome['type'] == "welcome", welcome
+
+        reply = yield self.request({"type": "auth", "mode": "test",
+                                    "handle": self.handle})
+        if not reply.get('success'):
+            raise RuntimeError("Could not sign in as %s: %r" % (self.handle, reply))
+        self.user_id = reply['user']['id']
+
+        yield self.request({"type": "join", "target": self.channel})
+
+    @tornado.gen.coroutine
+    def request(self, obj):
+        future = self._wait()
+        self.send(obj)
+        reply = yield future
+        return reply
+
+    @tornado.gen.coroutine
+    def run(self, until, kinds, weights, user_ids, channels):
+        n = 0
+        while time.monotonic() < until and not self.closed:
+            kind = self.rng.choices(kinds, weights)[0]
+            obj = self.make(kind, n, user_ids, channels)
+            n += 1
+
+            start = time.monotonic()
+            reply = yield self.request(obj)
+            self.stats.reply(kind, (time.monotonic() - start) * 1000, reply)
+
+            if options.think:
+                yield tornado.gen.sleep(options.think)
+
+    def make(self, kind, n, user_ids, channels):
+        if kind == "message":
+            return {"type": "message", "target": self.channel,
+                    "body": "Load test message %d from %s." % (n, self.handle)}
+        if kind == "backlog":
+            return {"type": "backlog", "target": self.channel, "count": 50}
+        if kind == "join":
+            return {"type": "join", "target": self.rng.choice(channels)}
+        if kind == "user":
+            return {"type": "user", "id": self.rng.choice(user_ids)}
+        raise ValueError("Unknown request type '%s'." % kind)
+
+    def _wait(self):
+        future = tornado.concurrent.Future()
+        self._pending.append(future)
+        return future
+
+    def _on_message(self, message):
+        type_ = message.get('type')
+
+        if type_ == "ping":
+            self.send({"type": "pong"})
+            return
+        if type_ == "missed" or (type_ == "message" and
+                                 message['from']['handle'] != self.handle):
+            if type_ == "message":
+                self.stats.broadcast(time.time() * 1000 - message['ts'])
+            return
+
+        if self._pending:
+            self._pending.popleft().set_result(message)
+
+    def _on_close(self):
+        self.closed = True
+        while self._pending:
+            self._pending.popleft().set_result({"type": "error", "subtype": "closed"})
+
+
+class TCPClient(Client):
+    transport = "tcp"
+
+    @tornado.gen.coroutine
+    def connect(self):
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        self.stream = yield tornado.tcpclient.TCPClient().connect(
+            options.host, options.tcp_port, ssl_options=ctx, max_buffer_size=MAX_LINE)
+
+    def send(self, obj):
+        self.stream.write(json.dumps(obj).encode('utf-8') + b'\n')
+
+    @tornado.gen.coroutine
+    def _read(self):
+        try:
+            while True:
+                line = yield self.stream.read_until(b'\n', max_bytes=MAX_LINE)
+                self._on_message(json.loads(line.decode('utf-8')))
+        except tornado.iostream.StreamClosedError:
+            pass
+        self._on_close()
+
+    def close(self):
+        self.stream.close()
+
+
+class WebSocketClient(Client):
+    transport = "websocket"
+
+    @tornado.gen.coroutine
+    def connect(self):
+        self.ws = yield tornado.websocket.websocket_connect(
+            "ws://%s:%d/ws" % (options.host, options.http_port))
+
+    def send(self, obj):
+        self.ws.write_message(json.dumps(obj))
+
+    @tornado.gen.coroutine
+    def _read(self):
+        while True:
+            data = yield self.ws.read_message()
+            if data is None:
+                break
+            for line in data.splitlines():
+                if line.strip():
+                    self._on_message(json.loads(line))
+        self._on_close()
+
+    def close(self):
+        self.ws.close()
+
+
+def make_certificate(directory):
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+                           "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                           "-keyout", keyfile, "-out", certfile],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def start_server(directory):
+    certfile, keyfile = options.certfile, options.keyfile
+    if certfile is None:
+        certfile, keyfile = make_certificate(directory)
+
+    config = os.path.join(directory, "load.toml")
+    with open(config, 'w') as f:
+        f.write('http = "%s:%d"\n' % (options.host, options.http_port))
+        f.write('tcp = "%s:%d"\n' % (options.host, options.tcp_port))
+        f.write('mongo = "%s"\n' % options.mongo)
+        f.write('certfile = "%s"\nkeyfile = "%s"\n' % (certfile, keyfile))
+        f.write('\n[properties]\ntwitter_key = ""\ntwitter_secret = ""\n')
+        f.write('test_auth = true\n')
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "server.py"),
+         "--config=%s" % config, "--logging=warning"] +
+        options.server_options.split(), cwd=ROOT)
+
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Server exited with %d." % server.returncode)
+        try:
+            socket.create_connection((options.host, options.tcp_port), 0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+
+    server.kill()
+    raise RuntimeError("Server did not start listening.")
+
+
+@tornado.gen.coroutine
+def load(pid):
+    rng = random.Random(options.seed)
+    stats = Stats()
+
+    kinds, weights = [], []
+    for part in options.mix.split(','):
+        kind, _, weight = part.partition(':')
+        kinds.append(kind.strip())
+        weights.append(float(weight))
+
+    rss_before = rss_bytes(pid) if pid else None
+
+    clients = []
+    for i in range(options.clients):
+        cls = WebSocketClient if rng.random() < options.ws_share else TCPClient
+        clients.append(cls(i, random.Random(rng.random()), stats))
+
+    start = time.monotonic()
+    yield [client.start() for client in clients]
+    connect_time = time.monotonic() - start
+
+    yield tornado.gen.sleep(1)
+    rss_idle = rss_bytes(pid) if pid else None
+
+    user_ids = [client.user_id for client in clients]
+    channels = ["#load%d" % i for i in range(options.channels)]
+
+    cpu_before = cpu_seconds(pid) if pid else None
+    start = time.monotonic()
+    yield [client.run(start + options.duration, kinds, weights, user_ids, channels)
+           for client in clients]
+    elapsed = time.monotonic() - start
+    cpu_after = cpu_seconds(pid) if pid else None
+    rss_loaded = rss_bytes(pid) if pid else None
+
+    for client in clients:
+        client.close()
+
+    requests = sum(len(v) for v in stats.latencies.values())
+    per_connection = None
+    if rss_before is not None and rss_idle is not None:
+        per_connection = (rss_idle - rss_before) / len(clients)
+
+    return {
+        "config": dict((k, getattr(options, k)) for k in (
+            'clients', 'ws_share', 'duration', 'channels', 'mix', 'think',
+            'seed', 'server_options')),
+        "transports": dict((t, sum(1 for c in clients if c.transport == t))
+                           for t in ("tcp", "websocket")),
+        "connect_seconds": connect_time,
+        "elapsed_seconds": elapsed,
+        "requests": requests,
+        "throughput_rps": requests / elapsed,
+        "latency": dict((k, summarise(v)) for k, v in sorted(stats.latencies.items())),
+        "latency_all": summarise([ms for v in stats.latencies.values() for ms in v]),
+        "broadcast_delivery": summarise(stats.broadcast_latencies()),
+        "errors": stats.errors,
+        "server": {
+            "rss_before_bytes": rss_before,
+            "rss_idle_bytes": rss_idle,
+            "rss_loaded_bytes": rss_loaded,
+            "rss_per_connection_bytes": per_connection,
+            "cpu_seconds": cpu_after - cpu_before if cpu_before is not None else None,
+            "cpu_percent": (cpu_after - cpu_before) / elapsed * 100
+                           if cpu_before is not None else None
+        }
+    }
+
+
+def report(results):
+    print("%d clients (%d tcp, %d websocket), connected in %.1fs" % (
+        results['config']['clients'], results['transports']['tcp'],
+        results['transports']['websocket'], results['connect_seconds']))
+    print("%d requests in %.1fs: %.0f/s" % (
+        results['requests'], results['elapsed_seconds'], results['throughput_rps']))
+
+    rows = sorted(results['latency'].items())
+    rows += [("all", results['latency_all']), ("broadcast", results['broadcast_delivery'])]
+    for name, s in rows:
+        if s['count']:
+            print("  %-10s %8d  p50 %7.2fms  p99 %7.2fms" % (
+                name, s['count'], s['p50_ms'], s['p99_ms']))
+
+    if results['errors']:
+        print("errors: %r" % results['errors'])
+
+    server = results['server']
+    if server['rss_per_connection_bytes'] is not None:
+        print("server: %.1f KiB RSS per connection, %.0f%% CPU under load" % (
+            server['rss_per_connection_bytes'] / 1024, server['cpu_percent']))
+
+
+def compare(a, b):
+    with open(a) as f:
+        before = json.load(f)
+    with open(b) as f:
+        after = json.load(f)
+
+    def line(name, x, y, unit):
+        if x is None or y is None:
+            return
+        change = (y - x) / x * 100 if x else 0
+        print("%-28s %10.2f %10.2f %+7.1f%% %s" % (name, x, y, change, unit))
+
+    print("%-28s %10s %10s" % ("", a, b))
+    line("throughput", before['throughput_rps'], after['throughput_rps'], "req/s")
+    for kind in sorted(set(before['latency']) | set(after['latency'])):
+        x, y = before['latency'].get(kind), after['latency'].get(kind)
+        if x and y:
+            line("%s p50" % kind, x['p50_ms'], y['p50_ms'], "ms")
+            line("%s p99" % kind, x['p99_ms'], y['p99_ms'], "ms")
+    line("broadcast p99", before['broadcast_delivery']['p99_ms'],
+         after['broadcast_delivery']['p99_ms'], "ms")
+    line("RSS per connection", before['server']['rss_per_connection_bytes'],
+         after['server']['rss_per_connection_bytes'], "bytes")
+    line("CPU", before['server']['cpu_percent'], after['server']['cpu_percent'], "%")
+
+
+def main():
+    tornado.options.parse_command_line()
+
+    if options.compare:
+        compare(*options.compare.split(','))
+        return
+
+    AsyncIOMainLoop().install()
+    loop = asyncio.get_event_loop()
+
+    with tempfile.TemporaryDirectory(prefix='robust-load-') as directory:
+        server = None
+        pid = options.pid
+        if not options.external:
+            server = start_server(directory)
+            pid = server.pid
+
+        try:
+            results = loop.run_until_complete(tornado.gen.convert_yielded(load(pid)))
+        finally:
+            if server is not None:
+                server.send_signal(signal.SIGINT)
+                server.wait()
+
+    report(results)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Measures the Python memory each idle TCP connection holds in the server:
+the protocol, its Session, logger and framer, and their entries in the
+session, channel and heartbeat indexes.
+
+Connections are made in-process over a stub transport, so TLS buffers and
+the socket itself aren't counted; bench/load.py reports the server's whole
+RSS per connection. Each state builds on the one before:
+
+    connected   welcome written, nothing received
+    signed in   logged in as its own user, in 3 channels
+    active      one ping answered, so the message handler exists
+
+    python bench/sessions.py [connections]
+"""
+import os
+import sys
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from entities import User
+import heartbeat
+import server
+
+CHANNELS = ["#robust", "#python", "#tornado"]
+
+
+class StubTransport:
+    def __init__(self, i):
+        self._extra = {
+            'peername': ("10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                         40000 + i % 20000),
+            'cipher': ("TLS_AES_256_GCM_SHA384", "TLSv1.3", 256)
+        }
+
+    def get_extra_info(self, name, default=None):
+        return self._extra.get(name, default)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def connect(transport):
+    conn = server.TCPServer()
+    conn.connection_made(transport)
+    return conn
+
+
+def sign_in(conn, i):
+    record = User.defaults()
+    record.update({
+        "_id": uuid.uuid4(),
+        "name": "User %d" % i,
+        "handle": "user%d" % i,
+        "channels": list(CHANNELS)
+    })
+    conn.session.login(User(None, record))
+
+
+def ping(conn, i):
+    conn.data_received(b'{"type": "ping"}\n')
+
+
+def measure(n):
+    server.properties = server.Properties()
+    server.HEARTBEATS = heartbeat.HeartbeatWheel()
+    server.MESSAGES_DB = None
+
+    transports = [StubTransport(i) for i in range(n)]
+    conns = []
+    tracemalloc.start()
+    yield None, tracemalloc.take_snapshot()
+
+    for transport in transports:
+        conns.append(connect(transport))
+    yield "connected", tracemalloc.take_snapshot()
+
+    for i, conn in enumerate(conns):
+        sign_in(conn, i)
+    yield "signed in", tracemalloc.take_snapshot()
+
+    for i, conn in enumerate(conns):
+        ping(conn, i)
+    yield "active", tracemalloc.take_snapshot()
+
+    tracemalloc.stop()
+    for conn in conns:
+        conn.connection_lost(None)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    states = measure(n)
+    _, baseline = next(states)
+    for state, snapshot in states:
+        stats = snapshot.compare_to(baseline, 'lineno')
+        total = sum(s.size_diff for s in stats)
+        print("%-10s %7.0f bytes per connection" % (state, total / n))
+
+        for stat in stats[:5]:
+            frame = stat.traceback[0]
+            print("    %7.0f  %s:%d" % (stat.size_diff / n,
+                                        os.path.basename(frame.filename), frame.lineno))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""A local stand-in for Twitter's verify_credentials endpoint.
+
+Every access token verifies, as a user whose screen name and id are derived
+from the token key, unless the key starts with "bad". Point the server at it
+with `twitter_verify_url` in the `[properties]` of the config:
+
+    python bench/twitter_stub.py --port=8000
+"""
+from tornado.options import define, options
+from tornado.web import RequestHandler, Application, url
+
+import hashlib
+import tornado.ioloop
+import tornado.options
+
+define('port', default=8000, help='Port to listen on.')
+
+
+def oauth_param(header, name):
+    for part in header.split(','):
+        k, _, v = part.strip().partition('=')
+        if k.endswith(name):
+            return v.strip('"')
+    return None
+
+
+class VerifyCredentialsHandler(RequestHandler):
+    def get(self):
+        key = oauth_param(self.request.headers.get('Authorization', ''),
+                          'oauth_token')
+
+        if key is None or key.startswith('bad'):
+            self.set_status(401)
+            self.write({"errors": [{"code": 89, "message": "Invalid token"}]})
+            return
+
+        uid = str(int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:12], 16))
+        self.write({
+            "id_str": uid,
+            "screen_name": "stub_%s" % key[:16],
+            "name": "Stub %s" % key[:16],
+            "description": "",
+            "location": "",
+            "utc_offset": 0,
+            "default_profile_image": True,
+            "profile_image_url_https": None
+        })
+
+
+def main():
+    tornado.options.parse_command_line()
+    Application([
+        url(r'/1.1/account/verify_credentials.json', VerifyCredentialsHandler)
+    ]).listen(options.port, '127.0.0.1')
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Compares the size and encode/decode time of the wire encodings for a
+typical broadcast message and a 100 message backlog reply.
+
+    python bench/wire.py
+"""
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import wire
+
+
+def message(i):
+    return {
+        "id": "5463c5c5e1382318d8a5a6%02x" % (i % 256),
+        "from": {
+            "id": uuid.uuid4().hex,
+            "handle": "brendan",
+            "name": "Brendan Molloy"
+        },
+        "ts": 1415824837000 + i,
+        "target": "#robust",
+        "body": "Chat traffic is highly repetitive, message %d." % i,
+        "type": "message"
+    }
+
+
+PAYLOADS = {
+    "message": message(0),
+    "backlog": {
+        "type": "backlog",
+        "target": "#robust",
+        "messages": [message(i) for i in range(100)]
+    }
+}
+
+
+def main():
+    if len(wire.CODECS) == 1:
+        print("(msgpack is not installed, only JSON is available)")
+
+    print("%-8s %-8s %8s %12s %12s" % ("payload", "codec", "bytes", "encode", "decode"))
+    for name, payload in PAYLOADS.items():
+        number = 20000 if name == "message" else 500
+        for codec in wire.CODECS.values():
+            data = codec.encode(payload)
+            body = data[4:] if codec.binary else data[:-1]
+            assert codec.decode(body) == payload
+
+            enc = timeit.timeit(lambda: codec.encode(payload), number=number)
+            dec = timeit.timeit(lambda: codec.decode(body), number=number)
+            print("%-8s %-8s %8d %10.2fus %10.2fus" % (
+                name, codec.name, len(data),
+                enc / number * 1e6, dec / number * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+import time
+
+
+class LRUCache:
+    """A mapping bounded to `maxsize` entries which evicts the least recently
+    used one first. With `ttl` set, entries also expire `ttl` seconds after
+    they were stored."""
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (expires, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, fallback=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return fallback
+
+        expires, value = entry
+        if expires is not None and expires <= self._clock():
+            del self._data[key]
+            self.misses += 1
+            return fallback
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        expires = None if self.ttl is None else self._clock() + self.ttl
+
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return value
+
+    def pop(self, key, fallback=None):
+        entry = self._data.pop(key, None)
+        return fallback if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
@@ -0,0 +1,77 @@
+class ChannelIndex:
+    """Maps channel targets and user handles to the session ids that should
+    receive messages sent to them, so a broadcast only visits members."""
+
+    def __init__(self):
+        self._members = {}   # target -> {session_id}
+        self._handles = {}   # handle -> {session_id}
+        self._sessions = {}  # session_id -> (handle, {target})
+
+    def add(self, session_id, handle, targets=()):
+        """Registers an authenticated session and its joined channels."""
+        self.remove(session_id)
+
+        self._sessions[session_id] = (handle, set())
+        self._handles.setdefault(handle, set()).add(session_id)
+
+        for target in targets:
+            self._subscribe(session_id, target)
+
+    def remove(self, session_id):
+        """Forgets a session, eg. on connection teardown."""
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return
+
+        handle, targets = entry
+
+        ids = self._handles.get(handle)
+        if ids is not None:
+            ids.discard(session_id)
+            if not ids:
+                del self._handles[handle]
+
+        for target in targets:
+            self._unsubscribe(session_id, target)
+
+    def join(self, handle, target):
+        """Subscribes every session of `handle` to `target`."""
+        for session_id in self.sessions_for(handle):
+            self._subscribe(session_id, target)
+
+    def part(self, handle, target):
+        """Unsubscribes every session of `handle` from `target`."""
+        for session_id in self.sessions_for(handle):
+            self._sessions[session_id][1].discard(target)
+            self._unsubscribe(session_id, target)
+
+    def members(self, target):
+        return self._members.get(target, frozenset())
+
+    def sessions_for(self, handle):
+        return self._handles.get(handle, frozenset())
+
+    def recipients(self, target, handle=None):
+        """Returns the session ids a message to `target` must reach.
+
+        Messages to `@handle` go to that user's sessions and to the other
+        sessions of the sender `handle`, everything else to channel members.
+        """
+        if target.startswith("@"):
+            ids = set(self.sessions_for(target[1:]))
+            if handle is not None:
+                ids.update(self.sessions_for(handle))
+            return ids
+        return self.members(target)
+
+    def _subscribe(self, session_id, target):
+        self._sessions[session_id][1].add(target)
+        self._members.setdefault(target, set()).add(session_id)
+
+    def _unsubscribe(self, session_id, target):
+        ids = self._members.get(target)
+        if ids is None:
+            return
+        ids.discard(session_id)
+        if not ids:
+            del self._members[target]
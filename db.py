@@ -1,15 +1,381 @@
+import base64
+import logging
 import pymongo
+import threading
+import tornado.gen
+import uuid
 
-from collections import deque
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import monitoring
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from tornado.concurrent import Future, chain_future, run_on_executor
+from tornado.ioloop import IOLoop
 
+from cache import LRUCache
 from dates import utcnow_millis
+from entities import User
+import metrics
+
+# collection -> [(keys, create_index kwargs)]
+INDEXES = {
+    "messages": [
+        ([("target", pymongo.ASCENDING), ("ts", pymongo.DESCENDING),
+          ("_id", pymongo.DESCENDING)], {}),
+        ([("target", pymongo.ASCENDING), ("from", pymongo.ASCENDING),
+          ("ts", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)], {})
+    ],
+    "users": [
+        ([("handle", pymongo.ASCENDING)], {"unique": True}),
+        # Only users who signed in with Twitter have a uid, the rest are null.
+        ([("twitter_uid", pymongo.ASCENDING)], {
+            "unique": True,
+            "partialFilterExpression": {"twitter_uid": {"$type": "string"}}
+        })
+    ]
+}
+
+# collection -> [keys], indexes since replaced in INDEXES, dropped so that
+# writes stop maintaining them.
+REPLACED_INDEXES = {
+    "messages": [
+        [("target", pymongo.ASCENDING), ("ts", pymongo.DESCENDING)],
+        [("target", pymongo.ASCENDING), ("from", pymongo.ASCENDING),
+         ("ts", pymongo.DESCENDING)]
+    ]
+}
+
+
+# Newest first, ties broken by _id so backlogs can be resumed after any
+# message.
+BACKLOG_ORDER = [("ts", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+
+
+def ensure_indexes(database):
+    """Creates any missing index in `INDEXES` and drops those in
+    `REPLACED_INDEXES`, returning the names of those in `INDEXES` that exist.
+
+    Every worker runs this at startup, so an index another worker dropped
+    first is skipped. A unique index the existing data violates is logged
+    and left unbuilt rather than stopping the server.
+    """
+    logger = logging.getLogger('db')
+    names = []
+    for collection, indexes in INDEXES.items():
+        for keys, kwargs in indexes:
+            try:
+                names.append(database[collection].create_index(keys, **kwargs))
+            except DuplicateKeyError as e:
+                logger.error("Could not build unique index %r on %s, "
+                             "duplicates must be removed first: %s",
+                             keys, collection, e)
+
+    for collection, replaced in REPLACED_INDEXES.items():
+        existing = database[collection].index_information()
+        for name, info in existing.items():
+            if list(info['key']) not in replaced:
+                continue
+            try:
+                database[collection].drop_index(name)
+            except OperationFailure:
+                pass  # Dropped by another worker meanwhile.
+    return names
+
+
+def hot_queries(database):
+    """Returns (description, cursor) for the queries run on every request."""
+    messages = database.messages
+    users = database.users
+    ts = {"$lte": utcnow_millis(), "$gte": 0}
+    before = [{"ts": {"$lt": 0}}, {"ts": 0, "_id": {"$lt": ObjectId()}}]
+
+    return [
+        ("backlog of channel", messages.find({"target": "#", "ts": ts})
+            .sort(BACKLOG_ORDER).limit(100)),
+        ("backlog of channel, continued", messages.find(
+            {"target": "#", "ts": ts, "$or": before}).sort(BACKLOG_ORDER).limit(100)),
+        ("backlog of user", messages.find({"target": "@", "from": {}, "ts": ts})
+            .sort(BACKLOG_ORDER).limit(100)),
+        ("user by handle", users.find({"handle": ""}).limit(1)),
+        ("user by twitter uid", users.find({"twitter_uid": ""}).limit(1))
+    ]
+
+
+def _plan_stages(plan):
+    yield plan.get('stage')
+    for child in plan.get('inputStages', [plan.get('inputStage')]):
+        if child is not None:
+            yield from _plan_stages(child)
+
+
+def unindexed_queries(database):
+    """Returns (description, stages) of each hot query whose winning plan
+    scans its collection or sorts in memory instead of using an index."""
+    o = []
+    for description, cursor in hot_queries(database):
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        stages = list(_plan_stages(plan))
+        if 'COLLSCAN' in stages or 'SORT' in stages:
+            o.append((description, stages))
+    return o
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Counts connection pool events across every server of a client."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.check_out_failed = 0
+        self.cleared = 0
+
+    def _incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    @property
+    def open(self):
+        return self.created - self.closed
+
+    @property
+    def in_use(self):
+        return self.checked_out - self.checked_in
+
+    def as_dict(self):
+        return {
+            "open": self.open,
+            "in_use": self.in_use,
+            "created": self.created,
+            "closed": self.closed,
+            "checked_out": self.checked_out,
+            "check_out_failed": self.check_out_failed,
+            "cleared": self.cleared
+        }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._incr('cleared')
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._incr('created')
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._incr('closed')
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._incr('check_out_failed')
+
+    def connection_checked_out(self, event):
+        self._incr('checked_out')
+
+    def connection_checked_in(self, event):
+        self._incr('checked_in')
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Times every MongoDB command into `metrics.MONGO`."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.MONGO.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        metrics.MONGO.observe(event.duration_micros / 1e6, event.command_name)
+        metrics.MONGO_FAILURES.inc(event.command_name)
+
+
+class MongoPool:
+    """The one MongoClient of the process, shared by every session.
+
+    MongoClient is thread-safe and pools its own sockets, so there should
+    only ever be one per process; `max_pool_size` bounds the sockets it may
+    open per server and `wait_queue_timeout` (ms) how long a caller waits for
+    one when they're all in use.
+
+    pymongo only offers blocking calls, so they are run on `executor`, a
+    pool of at most `workers` threads, and the event loop waits on futures.
+    """
+
+    def __init__(self, host='localhost', port=27017, name='robust',
+                 max_pool_size=100, min_pool_size=0, wait_queue_timeout=None,
+                 workers=8):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.stats = PoolStats()
+        self.client = pymongo.MongoClient(host, port,
+                                          maxPoolSize=max_pool_size,
+                                          minPoolSize=min_pool_size,
+                                          waitQueueTimeoutMS=wait_queue_timeout,
+                                          event_listeners=[self.stats, CommandTimer()])
+        self.database = self.client[name]
+
+    def close(self):
+        self.executor.shutdown()
+        self.client.close()
+
+
+def encode_token(ts, message_id):
+    """Returns an opaque token resuming a backlog after the message with
+    `ts` and `message_id`."""
+    token = "%d:%s" % (ts, message_id)
+    return base64.urlsafe_b64encode(token.encode('ascii')).decode('ascii')
+
+
+def decode_token(token):
+    """Returns the (ts, ObjectId) of a token from `encode_token`, raising
+    ValueError if it isn't one."""
+    try:
+        ts, _, message_id = base64.urlsafe_b64decode(
+            token.encode('ascii')).decode('ascii').partition(':')
+        return int(ts), ObjectId(message_id)
+    except (ValueError, InvalidId):
+        raise ValueError("Invalid backlog token.")
+
+
+def backlog_range(count=None, from_date=None, to_date=None):
+    """Returns (count, from_date, to_date) for a backlog query, with the
+    defaults filled in."""
+    if count is None:
+        count = 100
+
+    if from_date is None:
+        from_date = 0
+
+    if to_date is None:
+        to_date = utcnow_millis()
+
+    if not isinstance(from_date, int):
+        raise TypeError("from_date must be int (of microseconds).")
+
+    if not isinstance(to_date, int):
+        raise TypeError("to_date must be int (of microseconds).")
+
+    return count, from_date, to_date
+
+
+class BatchWriter:
+    """Write-behind queue for MessagesDB, persisting messages with
+    `insert_many` in batches of up to `batch_size`, or whatever is queued
+    `delay` seconds after the first message of a batch arrived.
+    """
+
+    def __init__(self, msgdb, batch_size=100, delay=0.05):
+        self.msgdb = msgdb
+        self.batch_size = batch_size
+        self.delay = delay
+        self.logger = logging.getLogger('db')
+
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+        self.max_batch_size = 0
+
+        self._queue = []  # [(message, future)]
+        self._handle = None
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def as_dict(self):
+        return {
+            "depth": self.depth,
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "max_batch_size": self.max_batch_size,
+            "mean_batch_size": self.written / self.batches if self.batches else 0
+        }
+
+    def insert(self, message):
+        """Returns a future resolved once the message's batch is persisted."""
+        future = Future()
+        self._queue.append((message, future))
+
+        if len(self._queue) >= self.batch_size:
+            self.flush()
+        elif self._handle is None:
+            self._handle = IOLoop.current().call_later(self.delay, self.flush)
+        return future
+
+    def flush(self):
+        """Sends everything queued to MongoDB as one batch."""
+        batch = self._take()
+        if not batch:
+            return
+
+        IOLoop.current().add_future(
+            self.msgdb.insert_many([m for m, _ in batch]),
+            lambda f: self._on_written(batch, f))
+
+    def close(self):
+        """Persists whatever is still queued, blocking until it's done."""
+        batch = self._take()
+        if batch:
+            self.msgdb.messages.insert_many([m for m, _ in batch], ordered=False)
+            self.written += len(batch)
+
+    def _take(self):
+        if self._handle is not None:
+            IOLoop.current().remove_timeout(self._handle)
+            self._handle = None
+
+        batch, self._queue = self._queue, []
+        if batch:
+            self.batches += 1
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            metrics.WRITE_BATCHES.observe(len(batch))
+        return batch
+
+    def _on_written(self, batch, future):
+        try:
+            future.result()
+        except Exception as e:
+            self.failed += len(batch)
+            self.logger.error("Failed to persist %d messages: %r" % (len(batch), e))
+            for _, f in batch:
+                f.set_exception(e)
+            return
+
+        self.written += len(batch)
+        for message, f in batch:
+            f.set_result(message['_id'])
 
 
 class MessagesDB:
-    def __init__(self, mongo_host='localhost', mongo_port=27017):
-        self.client = pymongo.MongoClient(mongo_host, mongo_port)
-        self.db = self.client.robust
+    """Message persistence; every method returns a future.
+
+    With `batch_size` set, inserts are queued and written behind in batches.
+    `ack` says whether a sender should wait for its message to be persisted
+    before it's broadcast, or broadcast first and let it persist after.
+    """
+
+    def __init__(self, database, executor, batch_size=None, batch_delay=0.05,
+                 ack=True):
+        self.db = database
         self.messages = self.db.messages
+        self.executor = executor
+        self.ack = ack
+        self.writer = BatchWriter(self, batch_size, batch_delay) if batch_size else None
 
     def insert(self, message):
         message = message.copy()  # Don't mangle original dict
@@ -18,24 +384,33 @@ class MessagesDB:
         if not message.get('ts', None):
             raise TypeError("Timestamp missing!")
 
-        return self.messages.insert(message)
-
-    def backlog(self, target, count=None, from_date=None, to_date=None, from_=None):
-        if count is None:
-            count = 100
+        if self.writer is not None:
+            return self.writer.insert(message)
+        return self._insert_one(message)
 
-        if from_date is None:
-            from_date = 0
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
 
-        if to_date is None:
-            to_date = utcnow_millis()
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
 
-        if not isinstance(from_date, int):
-            raise TypeError("from_date must be int (of microseconds).")
+    @run_on_executor
+    def _insert_one(self, message):
+        return self.messages.insert(message)
 
-        if not isinstance(to_date, int):
-            raise TypeError("to_date must be int (of microseconds).")
+    @run_on_executor
+    def insert_many(self, messages):
+        return self.messages.insert_many(messages, ordered=False)
 
+    @run_on_executor
+    def backlog_page(self, target, count, from_date, to_date, from_=None,
+                     before=None, fields=None):
+        """Returns up to `count` messages of `target` within the date range,
+        newest first, and only those older than the `(ts, _id)` of
+        `before` if given. With `fields`, only those and `ts` are fetched.
+        """
         q = {
             "target": target,
             "ts": {"$lte": to_date, "$gte": from_date}
@@ -46,14 +421,238 @@ class MessagesDB:
                 raise ValueError("cannot query messages to @target without from_ param")
             q['from'] = from_
 
-        # TODO indexing
-        cursor = self.messages.find(q) \
-            .sort("ts", pymongo.DESCENDING).limit(count)
+        if before is not None:
+            ts, message_id = before
+            q['$or'] = [{"ts": {"$lt": ts}}, {"ts": ts, "_id": {"$lt": message_id}}]
+
+        projection = None
+        if fields is not None:
+            projection = dict((f, True) for f in fields if f != 'id')
+            projection['ts'] = True
 
-        o = deque()
+        # Served by the (target, ts, _id) and (target, from, ts, _id) INDEXES.
+        cursor = self.messages.find(q, projection).sort(BACKLOG_ORDER).limit(count)
+
+        o = []
         for record in cursor:
-            record['id'] = str(record['_id'])
-            del record['_id']
-            o.appendleft(record)
+            record['id'] = str(record.pop('_id'))
+            o.append(record)
+        return o
+
+
+class UserCache:
+    """Recently used users by `_id`, also found by `handle` and
+    `twitter_uid`.
+
+    One `User` is kept per user and shared by all the sessions of that user
+    on this worker, so they see the same channels, and by lookups of it,
+    which reuse its cached public view. Users expire after `ttl` seconds,
+    bounding how long changes made by other workers or nodes go unseen.
+    """
+    FIELDS = ('handle', 'twitter_uid')
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.users = LRUCache(maxsize, ttl=ttl)
+        self._ids = LRUCache(maxsize * len(self.FIELDS), ttl=ttl)  # (field, value) -> _id
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, user_id):
+        return self.users.get(user_id)
+
+    def find(self, field, value):
+        user_id = self._ids.get((field, value))
+        if user_id is None:
+            return None
+
+        user = self.users.get(user_id)
+        if user is None or user.get(field) != value:
+            return None  # Evicted, or the field has changed since.
+        return user
+
+    def store(self, user):
+        """Caches `user`, returning the one already cached with its `_id`
+        if there is one, so lookups racing each other share it."""
+        cached = self.users.get(user['_id'])
+        if cached is not None and cached is not user:
+            return cached
+
+        self.users.set(user['_id'], user)
+        self._index(user)
+        return user
+
+    def replace(self, user):
+        self.users.pop(user['_id'])
+        return self.store(user)
+
+    def refresh(self, user):
+        """Indexes the fields of a saved `user` again, if it's the one
+        cached. One that has since expired or been forgotten is left out,
+        as it may be stale."""
+        if self.users.get(user['_id']) is user:
+            self._index(user)
+
+    def _index(self, user):
+        for field in self.FIELDS:
+            if user.get(field) is not None:
+                self._ids.set((field, user[field]), user['_id'])
+
+    def forget(self, field, value):
+        user = self.find(field, value)
+        if user is not None:
+            self.users.pop(user['_id'])
+
+
+class UsersDB:
+    """User lookups and persistence; every method returns a future.
+
+    Lookups are answered from `cache` where possible. Lookups by id return
+    a user's public view, the others the `User` itself, which serialises as
+    the authorised view for its own session.
+
+    Saves send only what changed. With `save_delay` set, a save waits that
+    many seconds so that changes to the same user made meanwhile, such as a
+    client joining its channels one by one, are sent together.
+    """
+
+    def __init__(self, database, executor, cache=None, save_delay=0):
+        self.db = database
+        self.users = self.db.users
+        self.executor = executor
+        self.cache = cache if cache is not None else UserCache()
+        self.save_delay = save_delay
+
+        self._saving = {}  # user -> [futures waiting for its next save]
+
+    @tornado.gen.coroutine
+    def from_id(self, user_id):
+        user_id = uuid.UUID(user_id)
+
+        user = self.cache.get(user_id)
+        if user is None:
+            user = self._store((yield self._find_one({"_id": user_id})))
+        return user.view(False)
+
+    @tornado.gen.coroutine
+    def from_ids(self, user_ids):
+        """Returns a dict of the public views of those of `user_ids` that
+        exist, fetching all those not cached in one query."""
+        o = {}
+        wanted = {}
+
+        for user_id in user_ids:
+            try:
+                key = uuid.UUID(user_id)
+            except ValueError:
+                continue
+
+            user = self.cache.get(key)
+            if user is None:
+                wanted[key] = user_id
+            else:
+                o[user_id] = user.view(False)
+
+        if wanted:
+            documents = yield self._find({"_id": {"$in": list(wanted)}})
+            for document in documents:
+                o[wanted[document['_id']]] = self._store(document).view(False)
+
+        return o
+
+    @tornado.gen.coroutine
+    def from_twitter(self, user_id):
+        user = self.cache.find('twitter_uid', user_id)
+        if user is None:
+            user = self._store((yield self._find_one({"twitter_uid": user_id})))
+        return user
+
+    @tornado.gen.coroutine
+    def from_handle(self, handle):
+        user = self.cache.find('handle', handle)
+        if user is None:
+            user = self._store((yield self._find_one({"handle": handle})))
+        return user
+
+    @tornado.gen.coroutine
+    def create(self, obj):
+        try:
+            user = yield self._create(obj)
+        except DuplicateKeyError:
+            # Created meanwhile, eg. by another session signing up.
+            return (yield self.from_handle(obj['handle']))
+        return self.cache.replace(user)
+
+    @tornado.gen.coroutine
+    def create_from_twitter(self, user_obj):
+        """Like create; raises ValueError if the Twitter handle is taken
+        by a user who isn't this Twitter account."""
+        try:
+            user = yield self._create_from_twitter(user_obj)
+        except DuplicateKeyError:
+            try:
+                return (yield self.from_twitter(user_obj['id_str']))
+            except ValueError:
+                raise ValueError("Handle '%s' is already taken." % user_obj['screen_name'])
+        return self.cache.replace(user)
+
+    @tornado.gen.coroutine
+    def save(self, user):
+        if self.save_delay:
+            yield self._save_later(user)
+        else:
+            yield self._update(user['_id'], user.pop_updates())
+        self.cache.refresh(user)
+
+    def close(self):
+        """Saves users still waiting out `save_delay`, blocking until done."""
+        saving, self._saving = self._saving, {}
+        for user in saving:
+            for update in user.pop_updates():
+                self.users.update_one({"_id": user['_id']}, update)
+
+    def _save_later(self, user):
+        future = Future()
+
+        waiting = self._saving.get(user)
+        if waiting is None:
+            waiting = self._saving[user] = []
+            IOLoop.current().call_later(self.save_delay, self._flush, user)
+        waiting.append(future)
+        return future
+
+    def _flush(self, user):
+        waiting = self._saving.pop(user, None)
+        if waiting is None:
+            return  # Saved by close.
+
+        saved = self._update(user['_id'], user.pop_updates())
+        for future in waiting:
+            chain_future(saved, future)
+
+    def _store(self, document):
+        return self.cache.store(User(self.users, document))
+
+    @run_on_executor
+    def _find_one(self, query):
+        document = self.users.find_one(query)
+        if document is None:
+            raise ValueError
+        return document
+
+    @run_on_executor
+    def _find(self, query):
+        return list(self.users.find(query))
+
+    @run_on_executor
+    def _create(self, obj):
+        return User.create(self.users, obj)
+
+    @run_on_executor
+    def _create_from_twitter(self, user_obj):
+        return User.create_from_twitter(self.users, user_obj)
 
-        return list(o)
+    @run_on_executor
+    def _update(self, user_id, updates):
+        for update in updates:
+            self.users.update_one({"_id": user_id}, update)
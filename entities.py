@@ -1,49 +1,68 @@
+import copy
 import uuid
 import itertools
 import json
 
-class User:
+
+class Entity:
+    """A stored document, with its schema declared by the subclass:
+
+        REQUIRED  fields that must be given on creation
+        DEFAULTS  the other fields, with their default values
+        PUBLIC    fields others may see, 'id' being `_id` as hex
+
+    The schema is compiled into `_fields` once, when the subclass is
+    defined. The public and authorised views are built on first use and
+    kept until a field changes, so they must not be modified.
+    """
+    __slots__ = ('_data', '_collection', '_authorised', '_views', '_dirty')
+
+    REQUIRED = ()
+    DEFAULTS = {}
+    PUBLIC = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = frozenset(itertools.chain(cls.DEFAULTS, cls.REQUIRED))
+        cls._readable = cls._fields | {'_id'}
+
     @classmethod
-    def public(self):
-        return ['id', 'name', 'handle', 'timezone', 'bio',
-                'display_picture', 'display_picture_large',
-                'location', 'is_server_admin',
-                'twitter_uid']
+    def public(cls):
+        return list(cls.PUBLIC)
 
-    # TODO: add 'email' as required
     @classmethod
     def required(cls):
-        return ['name', 'handle']
+        return list(cls.REQUIRED)
 
     @classmethod
     def defaults(cls):
-        return {
-            "location": "",
-            "bio": "",
-            "timezone": 0,
-            "display_picture": None,
-            "display_picture_large": None,
-            "twitter_uid": None,
-            "facebook_uid": None,
-            "github_uid": None,
-            "is_server_admin": False,
-            "channels": []
-        }
+        return copy.deepcopy(cls.DEFAULTS)
+
+    def __init__(self, collection, record, authorised=True):
+        self._data = record
+        self._collection = collection
+        self._authorised = authorised
+        # Both made on first use; most users are never changed.
+        self._views = None  # [public, authorised]
+        self._dirty = None  # Fields changed but not yet saved.
 
     def _to_json(self):
         return self.record
 
     def __getitem__(self, key):
-        if key in self.defaults() or key in self.required() or key == "_id":
+        if key in self._readable:
             return self._data[key]
-        raise KeyError
+        raise KeyError(key)
 
     def __setitem__(self, key, value):
-        if key in self.defaults() or key in self.required():
+        if key in self._fields:
             self._data[key] = value
-            # SAVE HERE
+            if self._dirty is None:
+                self._dirty = set()
+            self._dirty.add(key)
+            self._changed()
             return value
-        raise KeyError
+        raise KeyError(key)
 
     def get(self, key, fallback=None):
         try:
@@ -51,31 +70,128 @@ class User:
         except KeyError:
             return fallback
 
-
-    def __init__(self, collection, record, authorised=True):
-        self._data = record
-        self._collection = collection
-        self._authorised = authorised
-
-    def save(self):
-        self._collection.save(self._data)
+    def _changed(self):
+        self._views = None
 
     @property
     def record(self):
-        if not self._authorised:
+        return self.view(self._authorised)
+
+    def view(self, authorised):
+        if self._views is None:
+            self._views = [None, None]
+
+        i = 1 if authorised else 0
+        view = self._views[i]
+        if view is None:
+            view = self._views[i] = self._view(authorised)
+        return view
+
+    def _view(self, authorised):
+        data = self._data
+
+        if not authorised:
             o = {}
-            for p in self.public():
+            for p in self.PUBLIC:
                 if p == 'id':
-                    o[p] = self._data['_id'].hex
+                    o[p] = data['_id'].hex
                 else:
-                    o[p] = self._data[p]
-            return o
-        else:
-            o = self._data.copy()
-            o['id'] = o['_id'].hex
-            del o['_id']
+                    o[p] = data[p]
             return o
 
+        o = {}
+        for k, v in data.items():
+            # Lists are changed in place, and this view may outlive them.
+            o[k] = list(v) if isinstance(v, list) else v
+        o['id'] = o.pop('_id').hex
+        return o
+
+
+class User(Entity):
+    __slots__ = ('_added', '_removed')
+
+    PUBLIC = ('id', 'name', 'handle', 'timezone', 'bio',
+              'display_picture', 'display_picture_large',
+              'location', 'is_server_admin',
+              'twitter_uid')
+
+    # TODO: add 'email' as required
+    REQUIRED = ('name', 'handle')
+
+    DEFAULTS = {
+        "location": "",
+        "bio": "",
+        "timezone": 0,
+        "display_picture": None,
+        "display_picture_large": None,
+        "twitter_uid": None,
+        "facebook_uid": None,
+        "github_uid": None,
+        "is_server_admin": False,
+        "channels": []
+    }
+
+    def __init__(self, collection, record, authorised=True):
+        super().__init__(collection, record, authorised)
+        # Channels joined and parted but not yet saved.
+        self._added = None
+        self._removed = None
+
+    def add_channels(self, targets):
+        if self._added is None:
+            self._added, self._removed = set(), set()
+
+        channels = self._data['channels']
+        for target in targets:
+            if target not in channels:
+                channels.append(target)
+            self._removed.discard(target)
+            self._added.add(target)
+        self._changed()
+
+    def remove_channels(self, targets):
+        if self._added is None:
+            self._added, self._removed = set(), set()
+
+        channels = self._data['channels']
+        for target in targets:
+            if target in channels:
+                channels.remove(target)
+            self._added.discard(target)
+            self._removed.add(target)
+        self._changed()
+
+    def pop_updates(self):
+        """Returns the update documents saving the changes made since this
+        was last saved, and forgets those changes.
+
+        Channels are added and removed one by one, rather than by setting
+        the whole list, so sessions of the same user elsewhere don't undo
+        each other's joins and parts. Mongo won't add to and pull from one
+        array in a single update, so a pull is a second update.
+        """
+        updates = []
+        o = {}
+
+        if self._dirty:
+            o["$set"] = dict((k, self._data[k]) for k in self._dirty)
+
+        if self._added is not None and 'channels' not in (self._dirty or ()):
+            if self._added:
+                o["$addToSet"] = {"channels": {"$each": sorted(self._added)}}
+            if self._removed:
+                updates.append({"$pull": {"channels": {"$in": sorted(self._removed)}}})
+
+        if o:
+            updates.insert(0, o)
+
+        self._dirty = self._added = self._removed = None
+        return updates
+
+    def save(self):
+        for update in self.pop_updates():
+            self._collection.update_one({"_id": self._data['_id']}, update)
+
     @classmethod
     def create(cls, collection, obj):
         for k in cls.required():
@@ -84,7 +200,7 @@ class User:
 
         o = cls.defaults()
 
-        for k in itertools.chain(cls.defaults(), cls.required()):
+        for k in cls._fields:
             if k in obj:
                 o[k] = obj[k]
 
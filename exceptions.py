@@ -5,3 +5,14 @@ class NotAuthenticatedError(Exception):
 class MessageError(Exception):
     pass
 
+
+class ProtocolError(Exception):
+    pass
+
+
+class ValidationError(MessageError):
+    """A message not matching the schema of its type."""
+
+    def __init__(self, message, field=None):
+        super().__init__(message)
+        self.field = field
@@ -0,0 +1,94 @@
+import struct
+
+from exceptions import ProtocolError
+
+MAX_LINE = 64 * 1024
+
+
+class LineFramer:
+    """Splits a byte stream into newline delimited lines.
+
+    Each chunk is scanned once and every line copied once, so the cost of
+    `feed` is linear in the size of the chunk however many lines it holds.
+    A partial line is held until its newline arrives, up to `max_line`
+    bytes; a longer line raises ProtocolError.
+    """
+    __slots__ = ('max_line', '_buf')
+
+    def __init__(self, max_line=MAX_LINE):
+        self.max_line = max_line
+        self._buf = bytearray()
+
+    def __len__(self):
+        return len(self._buf)
+
+    def feed(self, data):
+        """Returns the lines completed by `data`, without their newlines."""
+        lines = []
+        buf = self._buf
+        start = 0
+        end = data.find(b'\n')
+
+        while end > -1:
+            if end - start + len(buf) > self.max_line:
+                self._overflow()
+
+            if buf:
+                buf += memoryview(data)[start:end]
+                lines.append(bytes(buf))
+                buf.clear()
+            else:
+                lines.append(data[start:end])
+
+            start = end + 1
+            end = data.find(b'\n', start)
+
+        if start < len(data):
+            if len(data) - start + len(buf) > self.max_line:
+                self._overflow()
+            buf += memoryview(data)[start:]
+        return lines
+
+    def _overflow(self):
+        self._buf.clear()
+        raise ProtocolError("Line exceeds maximum length of %d bytes." % self.max_line)
+
+
+class LengthPrefixedFramer:
+    """Splits a byte stream into frames each prefixed with its length, a
+    4 byte big endian unsigned int. Frames over `max_size` bytes raise
+    ProtocolError."""
+    __slots__ = ('max_size', '_buf')
+
+    _header = struct.Struct('>I')
+
+    def __init__(self, max_size=MAX_LINE):
+        self.max_size = max_size
+        self._buf = bytearray()
+
+    def __len__(self):
+        return len(self._buf)
+
+    def feed(self, data):
+        """Returns the payloads of the frames completed by `data`."""
+        buf = self._buf
+        buf += data
+
+        frames = []
+        pos = 0
+        end = len(buf)
+
+        with memoryview(buf) as view:
+            while end - pos >= 4:
+                size, = self._header.unpack_from(view, pos)
+                if size > self.max_size:
+                    view.release()
+                    buf.clear()
+                    raise ProtocolError("Frame exceeds maximum length of %d bytes." % self.max_size)
+                if end - pos - 4 < size:
+                    break
+                frames.append(bytes(view[pos + 4:pos + 4 + size]))
+                pos += 4 + size
+
+        del buf[:pos]
+        return frames
@@ -0,0 +1,89 @@
+import math
+import time
+
+IDLE_WAIT = 180
+READ_WAIT = 30
+TICK = 1.0
+
+
+class HeartbeatWheel:
+    """A hashed timing wheel keeping idle connections in check.
+
+    Connections only record `last_activity` (a `time.monotonic()`
+    timestamp) as data arrives. The wheel keeps each connection in the slot
+    of the tick its next check is due, and `sweep`, called every `tick`
+    seconds, visits just the slots that came due since the last sweep.
+
+    A connection idle for `idle_wait` seconds gets `heartbeat()` called to
+    ping it; one still silent `read_wait` seconds later gets
+    `heartbeat_failed()` called to close it.
+    """
+
+    def __init__(self, idle_wait=IDLE_WAIT, read_wait=READ_WAIT, tick=TICK,
+                 clock=time.monotonic):
+        self.idle_wait = idle_wait
+        self.read_wait = read_wait
+        self.tick = tick
+
+        self._clock = clock
+        self._slots = [set() for _ in range(
+            math.ceil(max(idle_wait, read_wait) / tick) + 2)]
+        self._where = {}  # connection -> slot index
+        self._pings = {}  # connection -> time pinged
+        self._last_tick = self._tick_of(clock())
+
+    def __len__(self):
+        return len(self._where)
+
+    def add(self, conn):
+        self._schedule(conn, conn.last_activity + self.idle_wait)
+
+    def remove(self, conn):
+        i = self._where.pop(conn, None)
+        if i is not None:
+            self._slots[i].discard(conn)
+        self._pings.pop(conn, None)
+
+    def sweep(self):
+        now = self._clock()
+        current = self._tick_of(now)
+
+        for tick in range(self._last_tick + 1, current + 1):
+            self._last_tick = tick
+            i = tick % len(self._slots)
+            due, self._slots[i] = self._slots[i], set()
+
+            for conn in due:
+                del self._where[conn]
+                self._check(conn, now)
+
+    def _check(self, conn, now):
+        ping_at = self._pings.get(conn)
+
+        if ping_at is not None and conn.last_activity <= ping_at:
+            if now >= ping_at + self.read_wait:
+                del self._pings[conn]
+                conn.heartbeat_failed()
+            else:
+                self._schedule(conn, ping_at + self.read_wait)
+            return
+
+        self._pings.pop(conn, None)
+        deadline = conn.last_activity + self.idle_wait
+
+        if deadline > now:
+            self._schedule(conn, deadline)
+            return
+
+        self._pings[conn] = now
+        self._schedule(conn, now + self.read_wait)
+        conn.heartbeat()
+
+    def _schedule(self, conn, deadline):
+        tick = max(self._tick_of(deadline), self._last_tick + 1)
+        i = tick % len(self._slots)
+        self._slots[i].add(conn)
+        self._where[conn] = i
+
+    def _tick_of(self, t):
+        return int(math.ceil(t / self.tick))
@@ -0,0 +1,160 @@
+from collections import OrderedDict, deque
+
+from dates import utcnow_millis
+
+# Rough bytes a cached message costs besides its body.
+RECORD_OVERHEAD = 512
+
+
+def record_size(record):
+    return RECORD_OVERHEAD + len(record.get('body') or "")
+
+
+def record_key(record):
+    """Orders records as backlogs do, by ts then id."""
+    return (record['ts'], record['id'])
+
+
+class _Channel:
+    __slots__ = ('messages', 'since', 'size')
+
+    def __init__(self, since):
+        self.messages = deque()
+        # Every message of the channel whose record_key is at least this
+        # is held.
+        self.since = since
+        self.size = 0
+
+
+class HistoryCache:
+    """The newest messages of each channel, held in memory so that backlog
+    requests for recent history needn't query MongoDB.
+
+    Messages are written through by `MessageHandler.send` and channels are
+    warmed from backlog queries. Each channel keeps at most `per_channel`
+    messages; once all channels together exceed roughly `max_bytes`, the
+    least recently used channels are dropped.
+    """
+
+    def __init__(self, per_channel=200, max_bytes=64 * 1024 * 1024):
+        self.per_channel = per_channel
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._channels = OrderedDict()  # target -> _Channel
+
+    def __len__(self):
+        return len(self._channels)
+
+    def append(self, target, record):
+        """Adds a newly persisted message record to its channel's buffer."""
+        channel = self._channels.get(target)
+        if channel is None:
+            # Nothing is known of the history before now.
+            channel = self._channels[target] = _Channel((utcnow_millis() + 1, ""))
+        self._channels.move_to_end(target)
+
+        self._insert(channel, record)
+        self._trim(channel)
+        self._evict(target)
+
+    def get(self, target, count, from_date, to_date):
+        """Returns the newest `count` messages of `target` within the date
+        range, oldest first, or None if the buffer can't be sure it has
+        them all."""
+        channel = self._channels.get(target)
+        if channel is None:
+            self.misses += 1
+            return None
+
+        o = []
+        for record in reversed(channel.messages):
+            ts = record['ts']
+            if ts > to_date:
+                continue
+            if ts < from_date or len(o) == count:
+                break
+            o.append(record)
+
+        if len(o) == count:
+            covered = count == 0 or record_key(o[-1]) >= channel.since
+        else:
+            covered = (from_date, "") >= channel.since
+
+        if not covered:
+            self.misses += 1
+            return None
+
+        self._channels.move_to_end(target)
+        self.hits += 1
+        o.reverse()
+        return o
+
+    def token(self):
+        """Returns a token to pass to `warm` for a query started now."""
+        return self.evictions
+
+    def warm(self, target, records, count, from_date, token):
+        """Merges the result of a backlog query for the newest `count`
+        messages since `from_date` into the buffer of `target`.
+
+        Skipped if any channel was evicted since `token`, as messages sent
+        meanwhile may then be missing from both the result and the buffer.
+        """
+        if token != self.evictions:
+            return
+
+        # The result holds every message from its oldest on, or since
+        # from_date if it came up short.
+        since = (from_date, "") if len(records) < count else record_key(records[0])
+
+        channel = self._channels.get(target)
+        if channel is None:
+            channel = self._channels[target] = _Channel(since)
+        channel.since = min(channel.since, since)
+        self._channels.move_to_end(target)
+
+        ids = set(record['id'] for record in channel.messages)
+        for record in records:
+            if record['id'] not in ids:
+                self._insert(channel, record)
+
+        self._trim(channel)
+        self._evict(target)
+
+    def _insert(self, channel, record):
+        messages = channel.messages
+        key = record_key(record)
+        i = len(messages)
+        # Sends may finish out of order; keep the buffer sorted.
+        while i > 0 and record_key(messages[i - 1]) > key:
+            i -= 1
+
+        messages.insert(i, record)
+        size = record_size(record)
+        channel.size += size
+        self.size += size
+
+    def _trim(self, channel):
+        messages = channel.messages
+        while len(messages) > self.per_channel:
+            record = messages.popleft()
+            # Everything after the dropped record is still held.
+            oldest = (record_key(messages[0]) if messages
+                      else (record['ts'] + 1, ""))
+            channel.since = max(channel.since, oldest)
+            size = record_size(record)
+            channel.size -= size
+            self.size -= size
+
+    def _evict(self, keep):
+        while self.size > self.max_bytes and len(self._channels) > 1:
+            target, channel = self._channels.popitem(last=False)
+            if target == keep:
+                self._channels[target] = channel
+                continue
+            self.size -= channel.size
+            self.evictions += 1
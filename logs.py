@@ -0,0 +1,71 @@
+"""Logging that stays off the event loop.
+
+`start_queue_logging` hands the configured handlers to a QueueListener
+thread, leaving the loop to only queue records. Connections log through a
+`ConnectionLogger`, which formats nothing for levels that are disabled, so
+log calls should pass their arguments rather than formatting the message
+themselves.
+"""
+import logging
+import logging.handlers
+import queue
+
+
+def start_queue_logging(logger=None):
+    """Moves the handlers of `logger`, the root logger by default, onto a
+    background thread, returning the started QueueListener."""
+    logger = logger or logging.getLogger()
+    handlers = logger.handlers[:]
+    records = queue.SimpleQueue()
+
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+
+    listener = logging.handlers.QueueListener(records, *handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class ConnectionLogger:
+    """Logs for one connection. Records carry the `peer` and `session` id
+    as attributes for structured handlers, and the peer after the message
+    for plain ones.
+
+    Like a LoggerAdapter, but kept to three slots as there is one per
+    connection; the extra attributes are only built for enabled levels.
+    """
+    __slots__ = ('logger', 'peer', 'session_id')
+
+    def __init__(self, logger, peer, session_id):
+        self.logger = logger
+        self.peer = peer
+        self.session_id = session_id
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def exception(self, msg, *args, exc_info=True, **kwargs):
+        self.log(logging.ERROR, msg, *args, exc_info=exc_info, **kwargs)
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            kwargs['extra'] = {"peer": self.peer, "session": self.session_id}
+            suffix = " (%s)" % self.peer
+            # Messages are only %-formatted when there are arguments.
+            if args:
+                suffix = suffix.replace('%', '%%')
+            self.logger.log(level, "%s%s" % (msg, suffix), *args, **kwargs)
@@ -1,19 +1,45 @@
-from tornado.concurrent import Future
-from requests_oauthlib import OAuth1
+from tornado.concurrent import Future, is_future
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.ioloop import IOLoop
+from oauthlib.oauth1 import Client as OAuth1Client
 from bson.objectid import ObjectId
 
-import requests
+import json
+import tornado.gen
 import uuid
 
 from dates import utcnow_millis
+from db import backlog_range, decode_token, encode_token
 from exceptions import MessageError, NotAuthenticatedError
-from entities import User
+from schema import Field, compile_schema
+import metrics
+import wire
+
+TWITTER_VERIFY_URL = "https://api.twitter.com/1.1/account/verify_credentials.json"
+TWITTER_TIMEOUT = 10
+# Most users a single `users` request may look up.
+MAX_USERS = 100
+# Most messages a backlog may ask for, and per frame of the reply.
+MAX_BACKLOG_COUNT = 1000
+BACKLOG_PAGE_SIZE = 100
+# Fields of a message a backlog may be limited to.
+BACKLOG_FIELDS = frozenset(('id', 'from', 'ts', 'target', 'body', 'type'))
+# Most commands a single batch may hold.
+MAX_BATCH_COMMANDS = 50
+# Commands a batch may not hold: batches don't nest, and the others write
+# frames of their own, which would go out ahead of the batch reply.
+UNBATCHABLE = frozenset(('batch', 'backlog', 'encoding', 'compression'))
 
 
 class TwitterAuth:
+    __slots__ = ('session',)
+
     def __init__(self, session):
         self.session = session
-        self.logger = self.session.logger
+
+    @property
+    def logger(self):
+        return self.session.logger
 
     @property
     def key(self):
@@ -23,35 +49,61 @@ class TwitterAuth:
     def secret(self):
         return self.session.get('twitter_secret')
 
+    @property
+    def verify_url(self):
+        return self.session.get('twitter_verify_url') or TWITTER_VERIFY_URL
+
+    @property
+    def timeout(self):
+        return self.session.get('twitter_timeout') or TWITTER_TIMEOUT
+
     def generate_challenge(self):
         """Returns authentication challenge message, with OAuth URL."""
         nonce = uuid.uuid4().hex
 
         future = Future()
-        future.add_done_callback(lambda future: self.session.transport.write_json(
-            self.authenticate(future.result())))
+        future.add_done_callback(self._on_challenge_result)
         self.session.properties.futures[nonce] = future
 
         return {
             "url": "http://robust.brendan.so/auth/twitter?robust_token=%s" % nonce
         }
 
+    def _on_challenge_result(self, future):
+        IOLoop.current().add_future(self.authenticate(future.result()),
+            lambda f: self.session.transport.write_json(f.result()))
+
+    @tornado.gen.coroutine
     def test_auth_data(self, data):
-        """Returns a boolean for whether key/secret verify successfully."""
+        """Returns the Twitter user if key/secret verify successfully."""
         if data is None:
             return None
 
         key = data.get('key', None)
         secret = data.get('secret', None)
 
-        return self._oauth_challenge(key, secret)
+        verified = self.session.properties.verified_tokens
+        user_obj = verified.get((key, secret))
+
+        if user_obj is None:
+            user_obj = yield self._oauth_challenge(key, secret)
+            if user_obj is not None:
+                verified.set((key, secret), user_obj)
+        return user_obj
 
+    @tornado.gen.coroutine
     def get_user(self, user_obj):
+        users = self.session.usersdb
         try:
-            return User.from_twitter(self.session.db.users, user_obj['id_str'])
+            user = yield users.from_twitter(user_obj['id_str'])
         except ValueError:
-            return User.create_from_twitter(self.session.db.users, user_obj)
+            try:
+                user = yield users.create_from_twitter(user_obj)
+            except ValueError as e:
+                raise NotAuthenticatedError(str(e))
+        return user
 
+    @tornado.gen.coroutine
     def authenticate(self, data=None):
         """Returns message either with success or challenge."""
         if data is None:
@@ -67,12 +119,12 @@ class TwitterAuth:
         if access_token is None:
             access_token = data.get('access_token', None)
 
-        data = self.test_auth_data(access_token)
+        data = yield self.test_auth_data(access_token)
 
         if data is not None:
-            user = self.get_user(data)
-            self.session.set('user', user)
-            self.logger.info("authenticated with handle '%s'." % user['handle'])
+            user = yield self.get_user(data)
+            self.session.login(user)
+            self.logger.info("authenticated with handle '%s'.", user['handle'])
             o['user'] = user
             o['success'] = True
             o['data'] = {"key": access_token['key'],
@@ -82,24 +134,42 @@ class TwitterAuth:
             o['challenge'] = self.generate_challenge()
         return o
 
+    @tornado.gen.coroutine
     def _oauth_challenge(self, key, secret):
-        # TODO drop requests dependency, use tornado async http
-        oauth = OAuth1(self.key,
-                       client_secret=self.secret,
-                       resource_owner_key=key,
-                       resource_owner_secret=secret)
+        oauth = OAuth1Client(self.key,
+                             client_secret=self.secret,
+                             resource_owner_key=key,
+                             resource_owner_secret=secret)
+        url, headers, _ = oauth.sign(self.verify_url)
 
-        r = requests.get(url="https://api.twitter.com/1.1/account/verify_credentials.json",
-                         auth=oauth)
+        try:
+            r = yield AsyncHTTPClient().fetch(url, headers=headers,
+                                              request_timeout=self.timeout)
+        except HTTPError as e:
+            self.logger.debug('oauth: %s', e.code)
+            if e.response is None:
+                raise MessageError("Could not reach Twitter, try again later.")
+            return None
+        except OSError as e:
+            # Refused connections, failed DNS lookups and TLS errors.
+            self.logger.warning("oauth: could not reach Twitter: %r", e)
+            raise MessageError("Could not reach Twitter, try again later.")
 
-        self.logger.debug('oauth: %s' % r.status_code)
-        return r.json() if r.status_code == 200 else None
+        self.logger.debug('oauth: %s', r.code)
+        try:
+            return json.loads(r.body.decode('utf-8'))
+        except ValueError:
+            self.logger.warning("oauth: invalid response from Twitter.")
+            raise NotAuthenticatedError("Twitter sent an invalid response, try again later.")
 
 
 class MessageHandler:
+    __slots__ = ('session',)
+
     def __init__(self, session):
         self.session = session
 
+    @tornado.gen.coroutine
     def send(self, obj):
         target = obj.get("target", None)
         body = obj.get('body', None)
@@ -134,37 +204,137 @@ class MessageHandler:
             "type": "message"
         }
 
-        self.session.msgdb.insert(o)
+        persisted = self.session.msgdb.insert(o)
+        if self.session.msgdb.ack:
+            yield persisted
+        else:
+            persisted.add_done_callback(self._on_persisted)
 
         # For great JSON.
-        o["original_body"] = original_body
         o['id'] = str(o['_id'])
         del o['_id']
 
+        if not target.startswith("@"):
+            self.session.history.append(target, o.copy())
+
+        o["original_body"] = original_body
+
         self.session.transport.broadcast(o)
 
         return o
 
+    def _on_persisted(self, future):
+        # Only called for messages already broadcast without waiting.
+        if future.cancelled() or future.exception() is None:
+            return
+        metrics.UNSAVED.inc()
+        self.session.logger.error("Broadcast message not persisted: %r",
+                                  future.exception())
+
     def parse(self, body):
         return body
 
 
 class SocketMessageHandler:
+    # The message types clients may send, each handled by the method of the
+    # same name, with the fields it takes. Compiled into COMMANDS.
+    SCHEMAS = {
+        "batch": {"commands": Field(list, items=dict)},
+        "ping": {},
+        "pong": {},
+        "message": {"target": Field(str), "body": Field(str)},
+        "emote": {},
+        "join": {"target": Field(str, list, items=str)},
+        "part": {"target": Field(str, list, items=str)},
+        "backlog": {
+            "target": Field(str),
+            "count": Field(int, required=False),
+            "from_date": Field(int, required=False),
+            "to_date": Field(int, required=False),
+            "before": Field(str, required=False),
+            "fields": Field(list, items=str, required=False)
+        },
+        "encoding": {"encoding": Field(str)},
+        "compression": {"compression": Field(str)},
+        "option": {"name": Field(str)},
+        "auth": {
+            "mode": Field(str),
+            "challenge": Field(dict, required=False),
+            "access_token": Field(dict, required=False),
+            "handle": Field(str, required=False)
+        },
+        "user": {"id": Field(str)},
+        "users": {"ids": Field(list, items=str)}
+    }
+
+    # One of these exists per connection that has sent a request, so the
+    # helpers below are only made for connections that use them.
+    __slots__ = ('session', '_message_handler', '_twitter_auth')
+
     def __init__(self, session):
         self.session = session
-        self.message_handler = MessageHandler(self.session)
-        self.twitter_auth = TwitterAuth(self.session)
+        self._message_handler = None
+        self._twitter_auth = None
+
+    @property
+    def message_handler(self):
+        if self._message_handler is None:
+            self._message_handler = MessageHandler(self.session)
+        return self._message_handler
+
+    @property
+    def twitter_auth(self):
+        if self._twitter_auth is None:
+            self._twitter_auth = TwitterAuth(self.session)
+        return self._twitter_auth
+
+    @tornado.gen.coroutine
+    def batch(self, obj):
+        """Runs a list of commands in order, replying with all their replies
+        (or errors) in one message."""
+        limit = self.session.properties.get('batch_max_commands') or MAX_BATCH_COMMANDS
+        if len(obj['commands']) > limit:
+            raise MessageError("No more than %d commands may be batched." % limit)
+
+        replies = []
+        for command in obj['commands']:
+            if command.get('type') in UNBATCHABLE:
+                replies.append(create_error('message',
+                    "Command '%s' can't be batched." % command['type']))
+                continue
+
+            try:
+                replies.append((yield self.parse(command)))
+            except MessageError as e:
+                replies.append(create_error('message', e))
+            except NotAuthenticatedError as e:
+                replies.append(create_error('authentication', e))
 
+        return {
+            "type": "batch",
+            "replies": replies
+        }
+
+    @tornado.gen.coroutine
     def parse(self, obj):
-        # TODO add message validation here
-        type_ = obj.get('type', "_")
-        if type_.startswith("_"):
+        if not isinstance(obj, dict):
+            raise MessageError("A message must be an object.")
+
+        type_ = obj.get('type', None)
+        if not isinstance(type_, str):
             raise MessageError("No valid type specified.")
 
-        method = getattr(self, type_, None)
-        if method is None:
+        command = COMMANDS.get(type_)
+        if command is None:
             raise MessageError("No method found for type '%s'." % type_)
-        return method(obj)
+
+        validate, method = command
+        validate(obj)
+
+        o = method(self, obj)
+        if is_future(o):
+            o = yield o
+        return o
 
     def ping(self, obj):
         return {"type": "pong"}
@@ -178,55 +348,180 @@ class SocketMessageHandler:
     def emote(self, obj):
         return NotImplemented
 
-    def join(self, obj):
-        # TODO accept a list instead of a string; multi join!
+    def _user_and_targets(self, obj):
+        """Returns the session's user and the target, or list of targets,
+        of a join or part request."""
         user = self.session.get('user')
+        if user is None:
+            raise NotAuthenticatedError("You must be authenticated to %s." % obj['type'])
+
+        targets = obj['target']
+        if isinstance(targets, str):
+            targets = [targets]
 
-        user['channels'].append(obj['target'])
-        user.save()
+        if not targets:
+            raise MessageError("A valid target or list of targets is required.")
+
+        return user, targets
+
+    @tornado.gen.coroutine
+    def join(self, obj):
+        user, targets = self._user_and_targets(obj)
+
+        user.add_channels(targets)
+        yield self.session.usersdb.save(user)
+        for target in targets:
+            self.session.join(target)
 
         o = obj.copy()
         o['success'] = True
         return o
 
+    @tornado.gen.coroutine
     def part(self, obj):
-        # TODO part a channel
-        # TODO accept a list instead of a string; multi join!
-        user = self.session.get('user')
+        user, targets = self._user_and_targets(obj)
 
-        target = obj['target']
-
-        if target in user['channels']:
-            user['channels'].remove(target)
-
-        user.save()
+        user.remove_channels(targets)
+        yield self.session.usersdb.save(user)
+        for target in targets:
+            self.session.part(target)
 
         o = obj.copy()
         o['success'] = True
         return o
 
+    @tornado.gen.coroutine
     def backlog(self, obj):
+        """Replies with the newest `count` messages of `target` within the
+        date range, only those older than the message the `before` token
+        points to if given, and only their `fields` if given.
+
+        The messages go out in frames of at most `backlog_page_size`, the
+        newest frame first and the oldest message first within each, all
+        but the last with `more` set. If older messages may remain, the
+        last frame's `next` token asks for them.
+        """
         from_date = obj.get('from_date', None)
         to_date = obj.get('to_date', None)
         count = obj.get('count', None)
         # TODO from should be user id based on session.
         #from_ = obj.get('from', None)
         from_ = None
-        target = obj.get('target', None)
+        target = obj['target']
+        fields = obj.get('fields', None)
+        before = obj.get('before', None)
 
-        if target is None:
-            raise MessageError("A valid target is required.")
+        try:
+            latest = to_date is None and before is None
+            count, from_date, to_date = backlog_range(count, from_date, to_date)
+        except TypeError as e:
+            raise MessageError(str(e))
+
+        properties = self.session.properties
+        if count < 1:
+            raise MessageError("count must be at least 1.")
+        count = min(count, properties.get('backlog_max_count') or MAX_BACKLOG_COUNT)
+        page_size = properties.get('backlog_page_size') or BACKLOG_PAGE_SIZE
+
+        if before is not None:
+            try:
+                before = decode_token(before)
+            except ValueError as e:
+                raise MessageError(str(e))
+
+        if fields is not None:
+            unknown = set(fields) - BACKLOG_FIELDS
+            if unknown:
+                raise MessageError("Unknown backlog fields: %s." % ", ".join(sorted(unknown)))
+
+        history = self.session.history
+        direct = target.startswith("@")
+
+        cached = None
+        if not direct and before is None:
+            cached = history.get(target, count, from_date, to_date)
+
+        # Whole results from the database warm the history cache.
+        warming = cached is None and latest and not direct and fields is None \
+            and count <= history.per_channel
+        evictions = history.token()
+        fetched = []
+
+        newest = cached[::-1] if cached is not None else None
+        sent = 0
+
+        while True:
+            limit = min(page_size, count - sent)
+            if newest is not None:
+                page = newest[sent:sent + limit]
+            else:
+                page = yield self.session.msgdb.backlog_page(
+                    target, limit, from_date, to_date, from_, before, fields)
+                if warming:
+                    fetched.extend(page)
+
+            sent += len(page)
+            exhausted = len(page) < limit
+            done = exhausted or sent >= count
+            if page:
+                before = (page[-1]['ts'], ObjectId(page[-1]['id']))
+
+            o = obj.copy()
+            o['count'] = count
+            o['messages'] = [self._project(record, fields) for record in reversed(page)]
+            o['more'] = not done
+            o['next'] = encode_token(*before) if done and not exhausted else None
+
+            if done:
+                break
+            self.session.transport.write_json(o)
+            if newest is not None:
+                yield tornado.gen.moment
+
+        if warming:
+            fetched.reverse()
+            history.warm(target, fetched, count, from_date, evictions)
 
-        obj['messages'] = self.session.msgdb.backlog(target, count,
-                                                     from_date, to_date, from_)
+        return o
 
-        return obj
+    def _project(self, record, fields):
+        if fields is None:
+            return record
+        return dict((f, record[f]) for f in fields if f in record)
 
-    def option(self, obj):
-        name = obj.get('name', None)
+    def encoding(self, obj):
+        name = obj['encoding']
+        codec = wire.CODECS.get(name)
+
+        if codec is None:
+            raise MessageError("Unsupported encoding '%s'." % name)
+
+        # Frames still queued would leave after the reply, which the client
+        # expects to be the last frame in the old encoding.
+        transport = self.session.transport
+        if not transport.flushed:
+            raise MessageError("Frames are still queued, try again shortly.")
+
+        # Reply in the current encoding, then switch.
+        transport.write_json({"type": "encoding", "encoding": name, "success": True})
+        transport.set_codec(codec)
 
-        if name is None:
-            raise MessageError("No name provided.")
+    def compression(self, obj):
+        name = obj['compression']
+        transport = self.session.transport
+
+        if name not in transport.compressions:
+            raise MessageError("Unsupported compression '%s'." % name)
+
+        # Frames still queued would go out compressed after the reply.
+        if not transport.flushed:
+            raise MessageError("Frames are still queued, try again shortly.")
+
+        transport.write_json({"type": "compression", "compression": name, "success": True})
+        transport.set_compression(name)
+
+    def option(self, obj):
+        name = obj['name']
 
         return {
             "name": name,
@@ -235,11 +530,9 @@ class SocketMessageHandler:
         }
 
 
+    @tornado.gen.coroutine
     def auth(self, obj):
-        mode = obj.get('mode', None)
-
-        if mode is None:
-            raise MessageError("No mode provided.")
+        mode = obj['mode']
 
         method = getattr(self, 'auth_%s' % mode, None)
 
@@ -247,6 +540,8 @@ class SocketMessageHandler:
             raise MessageError("No handler found for mode '%s'." % mode)
 
         o = method(obj)
+        if is_future(o):
+            o = yield o
         if o is not None:
             o['user'] = self.session.user
         return o
@@ -259,31 +554,92 @@ class SocketMessageHandler:
         username = obj.get('username', None)
         # TODO plain auth
 
+    @tornado.gen.coroutine
+    def auth_test(self, obj):
+        """Signs in as `handle` without any credentials, creating the user
+        if needed. For load tests only: refused unless the `test_auth`
+        property is set."""
+        if not self.session.properties.get('test_auth'):
+            raise MessageError("No handler found for mode 'test'.")
+
+        if self.session.is_authenticated():
+            raise MessageError("Session already authenticated.")
+
+        handle = obj.get('handle', None)
+        if not handle:
+            raise MessageError("No handle provided.")
+
+        users = self.session.usersdb
+        try:
+            user = yield users.from_handle(handle)
+        except ValueError:
+            user = yield users.create({"name": handle, "handle": handle})
+
+        self.session.login(user)
+        return {"type": "auth", "mode": "test", "success": True}
+
+    @tornado.gen.coroutine
     def user(self, obj):
-        user_id = obj.get('id', None)
-        if user_id is None:
-            raise MessageError("No user id provided.")
+        user_id = obj['id']
 
         try:
-            return {
-                "type": "user",
-                "id": user_id,
-                "user": User.from_id(self.session.db.users, user_id)
-            }
+            user = yield self.session.usersdb.from_id(user_id)
         except ValueError as e:
             raise MessageError("No user found for id '%s'." % user_id)
 
+        return {
+            "type": "user",
+            "id": user_id,
+            "user": user
+        }
+
+    @tornado.gen.coroutine
+    def users(self, obj):
+        user_ids = obj['ids']
+
+        if len(user_ids) > MAX_USERS:
+            raise MessageError("No more than %d users may be requested at once." % MAX_USERS)
+
+        users = yield self.session.usersdb.from_ids(user_ids)
+
+        return {
+            "type": "users",
+            "users": users,
+            "missing": [i for i in user_ids if i not in users]
+        }
+
+
+# type -> (validator, handler), compiled once from the schemas.
+COMMANDS = dict(
+    (type_, (compile_schema(schema), getattr(SocketMessageHandler, type_)))
+    for type_, schema in SocketMessageHandler.SCHEMAS.items())
+
+
+def request_type(obj):
+    """Returns the type of a request for metrics, one of COMMANDS or
+    "unknown" so clients can't add labels at will."""
+    type_ = obj.get('type') if isinstance(obj, dict) else None
+    return type_ if isinstance(type_, str) and type_ in COMMANDS else "unknown"
+
 
 def create_error(subtype, err):
-    return {
+    metrics.ERRORS.inc(subtype)
+    o = {
         "type": "error",
         "subtype": subtype,
         "message": str(err)
     }
 
+    field = getattr(err, 'field', None)
+    if field is not None:
+        o['field'] = field
+    return o
+
 
-def create_welcome(motd):
+def create_welcome(motd, compressions=()):
     return {
         "type": "welcome",
-        "motd": motd
+        "motd": motd,
+        "encodings": list(wire.CODECS),
+        "compressions": list(compressions)
     }
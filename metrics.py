@@ -0,0 +1,178 @@
+"""In-process metrics, served in the Prometheus text format at /metrics.
+
+Every metric registers itself with `REGISTRY` when it's created. Each worker
+process keeps its own, so with `--workers` each scrape sees only the worker
+that accepted it.
+"""
+import bisect
+import threading
+
+# Seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (k, _escape(v)) for k, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    """A count that only goes up, one per combination of label values.
+
+    Safe to update from any thread, as MongoDB calls are timed on the
+    executor's.
+    """
+    kind = "counter"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}  # label values -> count
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, *labels):
+        self.add(1, *labels)
+
+    def add(self, amount, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield "%s%s %s" % (self.name, _labels(self.labels, labels), _number(value))
+
+
+class Gauge:
+    """A value read from `function` whenever metrics are rendered."""
+    kind = "gauge"
+
+    def __init__(self, name, help, function, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.function = function
+        registry.register(self)
+
+    def samples(self):
+        yield "%s %s" % (self.name, _number(self.function()))
+
+
+class _Buckets:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0
+        self.count = 0
+
+
+class Histogram:
+    """Observations counted into fixed `buckets`, one set per combination
+    of label values. Thread-safe like Counter."""
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=(),
+                 registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        self._series = {}  # label values -> _Buckets
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, *labels):
+        # The last count is for values above every bucket.
+        i = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = _Buckets(len(self.buckets) + 1)
+            series.counts[i] += 1
+            series.sum += value
+            series.count += 1
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series.count if series is not None else 0
+
+    def samples(self):
+        with self._lock:
+            series = sorted((labels, list(s.counts), s.sum, s.count)
+                            for labels, s in self._series.items())
+
+        for labels, counts, sum_, count in series:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                yield "%s_bucket%s %d" % (self.name, _labels(
+                    self.labels, labels, ("le", _number(bound))), cumulative)
+            yield "%s_sum%s %s" % (self.name, _labels(self.labels, labels), _number(sum_))
+            yield "%s_count%s %d" % (self.name, _labels(self.labels, labels), count)
+
+
+REQUESTS = Histogram('robust_request_seconds',
+                     "Time taken to handle a request, by message type.",
+                     labels=('type',))
+ERRORS = Counter('robust_errors_total', "Error replies sent, by subtype.",
+                 labels=('subtype',))
+MONGO = Histogram('robust_mongo_seconds',
+                  "Time taken by MongoDB commands, by command.",
+                  labels=('command',))
+MONGO_FAILURES = Counter('robust_mongo_failures_total',
+                         "MongoDB commands that failed, by command.",
+                         labels=('command',))
+RECIPIENTS = Histogram('robust_broadcast_recipients',
+                       "Local sessions each broadcast was written to.",
+                       COUNT_BUCKETS)
+DROPPED = Counter('robust_outbound_dropped_total',
+                  "Broadcasts dropped or coalesced for slow readers, by policy.",
+                  labels=('policy',))
+WRITE_BATCHES = Histogram('robust_write_batch_size',
+                          "Messages in each write-behind batch.", COUNT_BUCKETS)
+UNSAVED = Counter('robust_messages_unsaved_total',
+                  "Messages broadcast before persisting that then failed to persist.")
+BYTES_WRITTEN = Counter('robust_bytes_written_total',
+                        "Bytes written to clients, by transport.",
+                        labels=('transport',))
@@ -0,0 +1,66 @@
+"""Schemas of the messages clients send, declared as dicts of field names to
+`Field`s and compiled once into validators."""
+from exceptions import ValidationError
+
+TYPE_NAMES = {
+    str: ("a string", "strings"),
+    int: ("an integer", "integers"),
+    float: ("a number", "numbers"),
+    bool: ("a boolean", "booleans"),
+    list: ("a list", "lists"),
+    dict: ("an object", "objects")
+}
+
+
+class Field:
+    """A field of a message: the types its value may have, whether it's
+    required and, for lists, the types their items may have.
+
+    Types are matched exactly, so a boolean isn't taken for an integer. A
+    field that is null counts as missing.
+    """
+    __slots__ = ('types', 'required', 'items')
+
+    def __init__(self, *types, required=True, items=None):
+        self.types = frozenset(types)
+        self.required = required
+        if items is not None and not isinstance(items, tuple):
+            items = (items,)
+        self.items = frozenset(items) if items is not None else None
+
+    def describe(self, name):
+        names = []
+        for t in self.types:
+            if t is list and self.items is not None:
+                names.append("a list of %s" % " or ".join(
+                    sorted(TYPE_NAMES[i][1] for i in self.items)))
+            else:
+                names.append(TYPE_NAMES[t][0])
+        return "'%s' must be %s." % (name, " or ".join(sorted(names)))
+
+
+def compile_schema(schema):
+    """Returns a function validating a message against `schema`, raising
+    ValidationError for the first field that doesn't match."""
+    checks = tuple((name, field.types, field.required, field.items,
+                    field.describe(name))
+                   for name, field in sorted(schema.items()))
+
+    def validate(obj):
+        for name, types, required, items, error in checks:
+            value = obj.get(name)
+
+            if value is None:
+                if required:
+                    raise ValidationError("'%s' is required." % name, name)
+                continue
+
+            if type(value) not in types:
+                raise ValidationError(error, name)
+
+            if items is not None and type(value) is list:
+                for item in value:
+                    if type(item) not in items:
+                        raise ValidationError(error, name)
+
+    return validate
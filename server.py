@@ -1,32 +1,93 @@
 from tornado.platform.asyncio import AsyncIOMainLoop
 from tornado.web import RequestHandler, Application, url
+from tornado.concurrent import Future
 from tornado.options import define, options
-from io import BytesIO
+from collections import deque
 
-import pymongo
 import tornado.auth
 import tornado.gen
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.websocket
 import toml
 
 import asyncio
+import itertools
 import json
-import uuid
+import signal
+import tempfile
 import logging
 import time
 import ssl
 
-from exceptions import MessageError, NotAuthenticatedError
+from cache import LRUCache
+from channels import ChannelIndex
+from history import HistoryCache
+from logs import ConnectionLogger
+from exceptions import MessageError, NotAuthenticatedError, ProtocolError
+from framing import MAX_LINE
+import heartbeat
+import logs
+import metrics
+import cluster
+import compression
 import messages
 import db
+import wire
+import workers
 
 ARROW_LEFT = "<-"
 ARROW_RIGHT = "->"
 
+INBOUND_QUEUE_SIZE = 100
+OUTBOUND_QUEUE_SIZE = 1000
+OUTBOUND_POLICY = "drop_oldest"
+
 define('http', default='127.0.0.1:8888', help='HTTP host:port')
 define('tcp', default='127.0.0.1:8889', help='TCP host:port')
 define('mongo', default='127.0.0.1:27017', help='MongoDB host:port')
+define('mongo_pool_size', default=100, type=int,
+       help='Maximum MongoDB connections per server, shared by all sessions.')
+define('mongo_min_pool_size', default=0, type=int,
+       help='MongoDB connections to keep open while idle.')
+define('mongo_wait_timeout', default=None, type=int,
+       help='Milliseconds to wait for a free MongoDB connection.')
+define('db_workers', default=8, type=int,
+       help='Threads running blocking MongoDB calls off the event loop.')
+define('indexes', default=True, type=bool,
+       help='Create missing MongoDB indexes at startup.')
+define('check_indexes', default=False, type=bool,
+       help='Report hot queries not served by an index, then exit.')
+define('idle_wait', default=heartbeat.IDLE_WAIT, type=int,
+       help='Seconds a connection may be silent before it is pinged.')
+define('read_wait', default=heartbeat.READ_WAIT, type=int,
+       help='Seconds a pinged connection has to respond before it is closed.')
+define('max_line', default=MAX_LINE, type=int,
+       help='Longest request line in bytes; longer ones close the connection.')
+define('workers', default=1, type=int,
+       help='Worker processes sharing the listeners through SO_REUSEPORT.')
+define('ipc_dir', help='Directory for the Unix sockets linking workers.')
+define('cluster', default=False, type=bool,
+       help='Relay broadcasts to other nodes through a capped collection.')
+define('cluster_collection_size', default=cluster.COLLECTION_SIZE, type=int,
+       help='Bytes of the capped collection carrying cluster events.')
+define('ws_compression', default=False, type=bool,
+       help='Offer permessage-deflate to WebSocket clients.')
+define('ws_compression_level', default=compression.LEVEL, type=int,
+       help='zlib level of WebSocket compression, 1 (fastest) to 9.')
+define('ws_compression_mem_level', default=compression.MEM_LEVEL, type=int,
+       help='zlib memory level of WebSocket compression, 1 to 9.')
+define('tcp_compression', default=False, type=bool,
+       help='Let TCP clients switch their connection to a zlib stream.')
+define('tcp_compression_level', default=compression.LEVEL, type=int,
+       help='zlib level of TCP compression, 1 (fastest) to 9.')
+define('tcp_compression_wbits', default=compression.WBITS, type=int,
+       help='zlib window of TCP compression, 9 to 15 (32KB).')
+define('tcp_compression_mem_level', default=compression.MEM_LEVEL, type=int,
+       help='zlib memory level of TCP compression, 1 to 9.')
 define('config', help='Configuration file. (toml format)')
 define('certfile', help="Certificate file.")
 define('keyfile', help="Key file.")
@@ -40,23 +101,35 @@ def create_ssl_context(certfile, keyfile):
     return ctx
 
 class Session:
+    __slots__ = ('_properties', '_transport', '_logger', '_msgdb', '_dict')
+
     def __init__(self, properties, transport, logger, msgdb):
         self._properties = properties
         self._transport = transport
         self._logger = logger
         self._msgdb = msgdb
+        self._dict = None  # Made by the first set().
 
-        self._db = MONGO_DB
-        self._dict = {}
+    @property
+    def id(self):
+        return self._transport.id
 
     @property
     def db(self):
-        return self._db
+        return MONGO_DB
 
     @property
     def msgdb(self):
         return self._msgdb
 
+    @property
+    def usersdb(self):
+        return USERS_DB
+
+    @property
+    def history(self):
+        return HISTORY
+
     @property
     def properties(self):
         return self._properties
@@ -79,12 +152,37 @@ class Session:
     def can_send(self, target):
         return True
 
+    def login(self, user):
+        self.set('user', user)
+        channels.add(self.id, user['handle'], user['channels'])
+        return user
+
+    def join(self, target):
+        channels.join(self.user['handle'], target)
+        for relay in RELAYS:
+            relay.publish("join", target, self.user['handle'])
+
+    def part(self, target):
+        channels.part(self.user['handle'], target)
+        for relay in RELAYS:
+            relay.publish("part", target, self.user['handle'])
+
+    @property
+    def queue_depth(self):
+        return self._transport.queue_depth
+
+    def close(self):
+        channels.remove(self.id)
+        sessions.pop(self.id, None)
+
     def set(self, thing, value):
+        if self._dict is None:
+            self._dict = {}
         self._dict[thing] = value
         return value
 
     def get(self, thing):
-        data = self._dict.get(thing, None)
+        data = self._dict.get(thing) if self._dict is not None else None
         if data is None:
             return self.properties.get(thing)
         return data
@@ -110,6 +208,9 @@ class Properties:
     def __init__(self, **kwargs):
         self._futures = {}
         self._auth_tokens = {}
+        self._verified_tokens = LRUCache(
+                kwargs.get('twitter_cache_size', 10000),
+                ttl=kwargs.get('twitter_cache_ttl', 300))
 
         opts = kwargs.get('options', None)
         if opts:
@@ -129,6 +230,11 @@ class Properties:
     def auth_tokens(self):
         return self._auth_tokens
 
+    @property
+    def verified_tokens(self):
+        """Recently verified Twitter (key, secret) pairs to user objects."""
+        return self._verified_tokens
+
     @property
     def options(self):
         return self._options
@@ -137,57 +243,200 @@ class Properties:
         return getattr(self, thing, None)
 
 
-class RobustWebSocket(tornado.websocket.WebSocketHandler):
-    def check_origin(self, origin):
-        return True
+class SessionProtocol:
+    """Request handling shared by the WebSocket and TCP transports.
+
+    Handlers may wait on the database, so lines are queued and handled one
+    at a time; replies therefore go out in the order requests came in. Once
+    `inbound_queue_size` lines wait, the rest of the input is held and
+    reading paused until the queue is half empty.
+
+    While the transport asks us to pause writing, outgoing frames wait in a
+    queue of at most `outbound_queue_size`. When a slow reader lets it
+    fill, `outbound_policy` decides what happens: "drop_oldest" drops the
+    oldest broadcast, "coalesce" replaces queued broadcasts with one
+    "missed" message naming the targets to fetch a backlog for, and
+    "disconnect" closes the connection. Replies are never dropped, as
+    clients match them to requests by order; a queue holding nothing else
+    is closed whatever the policy.
+
+    Servers hold many idle connections, so their state is slotted and the
+    line and outgoing queues and the message handler only exist while used.
+    """
+    __slots__ = ('id', 'session', 'logger', 'codec', 'dropped', 'last_activity',
+                 '_framer', '_stream', '_input', '_lines', '_processing',
+                 '_read_paused', '_outbox', '_paused', '_timer', '_handler')
+
+    # Stream compressions the client may switch to, see set_compression.
+    compressions = ()
+
+    def init_protocol(self):
+        self.id = next(SESSION_IDS)
+        self.codec = wire.JSON
+        self._framer = self.codec.framer(options.max_line)
+        self._stream = None
+        self._input = None
+        self._lines = None
+        self._processing = False
+        self._read_paused = False
+        self._outbox = None
+        self._paused = False
+        self._handler = None
+        self.dropped = 0
+        self.last_activity = time.monotonic()
+        HEARTBEATS.add(self)
 
-    def open(self):
-        self.id = uuid.uuid4().hex
-        self._buf = BytesIO()
-        
-        logger = logging.getLogger('websocket')
-        logger.info(self._format_log("Connection made!"))
-        self.logger = logger
-        
-        sessions[self.id] = Session(properties, self, logger, db.MessagesDB())
-        self.session = sessions[self.id]
-
-        self.message_handler = messages.SocketMessageHandler(self.session)
+    @property
+    def message_handler(self):
+        if self._handler is None:
+            self._handler = messages.SocketMessageHandler(self.session)
+        return self._handler
 
-        self.write_json(messages.create_welcome("Welcome to Robust alpha.\n\n" +
-                                                "This will be excellent."))
+    @property
+    def queue_depth(self):
+        return len(self._outbox) if self._outbox else 0
 
+    @property
+    def flushed(self):
+        """Whether a frame written now goes straight to the transport."""
+        return not self._paused and not self._outbox
 
     def start_timer(self):
-        self._timer = time.time() * 1000
+        self._timer = time.monotonic() * 1000
 
     def stop_timer(self):
         t = self._timer
         self._timer = None
-        return time.time() * 1000 - t
+        return time.monotonic() * 1000 - t
 
     def log_request(self, type_, ms):
-        self.logger.info("%s %.2fms" % (
-            self._format_log(type_.upper()), ms))
-    
-    def on_message(self, data):
-        data = data.encode('utf-8')
-
-        i = data.find(b'\n')
-        while i > -1:
-            self._buf.write(data[:i])
-            self.parse_line(self._buf.getvalue())
-            self._buf = BytesIO()
-            data = data[i+1:]
-            i = data.find(b'\n')
-        self._buf.write(data)
-    
+        metrics.REQUESTS.observe(ms / 1000, type_)
+        self.logger.info("%s %.2fms", type_.upper(), ms)
+
+    def close_protocol(self):
+        HEARTBEATS.remove(self)
+        self._input = None
+        self._lines = None
+        self.session.close()
+
+    def heartbeat(self):
+        self.write_json({"type": "ping"})
+
+    def heartbeat_failed(self):
+        self.logger.warning("No response in %s seconds, closing.",
+                            HEARTBEATS.read_wait)
+        self.disconnect()
+
+    def feed(self, data):
+        self.last_activity = time.monotonic()
+        lines = self._read_lines(data)
+        if self._input is None:
+            self._input = lines
+        else:
+            self._input = itertools.chain(self._input, lines)
+        self._take_input()
+
+    def _read_lines(self, data):
+        """Yields the lines completed by `data`. Compressed input is inflated
+        a chunk at a time as lines are taken, so it stops while reading is
+        paused however far the data would expand."""
+        if self._stream is None:
+            yield from self._framer.feed(data)
+        else:
+            for chunk in self._stream.decompress(data):
+                yield from self._framer.feed(chunk)
+
+    def _take_input(self):
+        """Queues held input lines until they run out, pausing reading
+        instead while the queue is full."""
+        limit = self._inbound_limit()
+        while self._input is not None:
+            if self._lines is not None and len(self._lines) >= limit:
+                if not self._read_paused:
+                    self._read_paused = True
+                    self.pause_reading()
+                return
+
+            try:
+                line = next(self._input, None)
+            except ProtocolError as e:
+                self._input = None
+                self.write_json(messages.create_error('protocol', e))
+                self.disconnect()
+                return
+
+            if line is None:
+                self._input = None
+            else:
+                self.parse_line(line)
+
+        if self._read_paused:
+            self._read_paused = False
+            self.resume_reading()
+
+    def _inbound_limit(self):
+        return properties.get('inbound_queue_size') or INBOUND_QUEUE_SIZE
+
+    def pause_reading(self):
+        """Stops the transport delivering data until resume_reading."""
+        raise NotImplementedError
+
+    def resume_reading(self):
+        raise NotImplementedError
+
+    def set_codec(self, codec):
+        """Switches both directions to `codec`. The client must wait for
+        the reply to its request before sending in the new encoding."""
+        self.codec = codec
+        self._framer = codec.framer(options.max_line)
+
+    def set_compression(self, name):
+        """Compresses both directions with `name`, one of `compressions`,
+        from the next frame on. Like set_codec, the client must wait for
+        the reply to its request before compressing."""
+        raise MessageError("Unsupported compression '%s'." % name)
+
+    def parse_line(self, data):
+        if self._lines is None:
+            self._lines = deque()
+        self._lines.append(data)
+        if not self._processing:
+            self._process_lines()
+
+    @tornado.gen.coroutine
+    def _process_lines(self):
+        self._processing = True
+        try:
+            while self._lines:
+                line = self._lines.popleft()
+                if self._read_paused and len(self._lines) <= self._inbound_limit() // 2:
+                    self._take_input()
+                try:
+                    yield self.handle_line(line)
+                except Exception:
+                    self.logger.exception("Request failed.")
+        finally:
+            self._processing = False
+            self._lines = None
+
+    @tornado.gen.coroutine
+    def handle_line(self, data):
+        self.start_timer()
+        self.logger.debug("%s %r", ARROW_LEFT, data)
+        try:
+            json_dict = self.codec.decode(data)
+        except ValueError as e:
+            self.write_json(messages.create_error("parser", e))
+            return
+
+        yield self.on_json(json_dict)
+
+    @tornado.gen.coroutine
     def on_json(self, json_dict):
         try:
-            msg = self.message_handler.parse(json_dict)
+            msg = yield self.message_handler.parse(json_dict)
             if msg is not None:
                 self.write_json(msg)
-            self.log_request(json_dict['type'], self.stop_timer())
         except MessageError as e:
             self.write_json(messages.create_error('message', e))
         except NotAuthenticatedError as e:
@@ -196,36 +445,188 @@ class RobustWebSocket(tornado.websocket.WebSocketHandler):
             self.write_json(messages.create_error('internal',
                 "An internal server error has occurred."))
             raise e
-
-    def on_close(self):
-        self.logger.info(self._format_log("Connection lost!"))
-        if sessions.get(self.id, None):
-            del sessions[self.id]
+        finally:
+            self.log_request(messages.request_type(json_dict), self.stop_timer())
 
     def write_json(self, data):
-        out = json.dumps(data, cls=JSONEncoder, separators=(',', ':'))
-        self.logger.debug(self._format_log("%s %s" % (ARROW_RIGHT, out)))
-        self.write_message(out.encode('utf-8') + b'\n')
+        self.write_frame(Frame(data))
+
+    def write_frame(self, frame, broadcast=False):
+        """Writes `frame`, a `broadcast` when it was sent to the target
+        rather than in reply to this connection."""
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("%s %s", ARROW_RIGHT, frame.text)
+
+        if self._paused or self._outbox:
+            self._enqueue(frame, broadcast)
+        else:
+            self.write_data(frame.encode(self.codec))
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        outbox = self._outbox
+        while outbox and not self._paused:
+            self.write_data(outbox.popleft()[1])
+        if not self._outbox:
+            self._outbox = None
+
+    def _enqueue(self, frame, broadcast):
+        # Encoded now, as the codec may change before the frame is written.
+        entry = (frame, frame.encode(self.codec), broadcast)
+        outbox = self._outbox
+        if outbox is None:
+            outbox = self._outbox = deque()
+        if len(outbox) >= (properties.get('outbound_queue_size') or OUTBOUND_QUEUE_SIZE):
+            policy = properties.get('outbound_policy') or OUTBOUND_POLICY
+
+            if policy == "drop_oldest":
+                dropped = self._drop_oldest()
+            else:
+                dropped = policy == "coalesce" and self._coalesce()
+
+            if not dropped:
+                self.logger.warning("Outbound queue full at %d frames after %d "
+                                    "dropped, disconnecting.", len(outbox), self.dropped)
+                outbox.clear()
+                self.disconnect()
+                return
+        self._outbox.append(entry)
+
+    def _drop_oldest(self):
+        """Drops the oldest queued broadcast, if there is one."""
+        for i, entry in enumerate(self._outbox):
+            if entry[2]:
+                del self._outbox[i]
+                self.dropped += 1
+                metrics.DROPPED.inc('drop_oldest')
+                return True
+        return False
+
+    def _coalesce(self):
+        """Replaces queued broadcasts with a single "missed" message."""
+        kept = deque()
+        missed = {}
+        dropped = 0
+
+        for entry in self._outbox:
+            message = entry[0].message
+            type_ = message.get('type')
+            if not entry[2]:
+                kept.append(entry)
+            elif type_ == "message":
+                missed[message['target']] = missed.get(message['target'], 0) + 1
+                dropped += 1
+            elif type_ == "missed":
+                for target, count in message['targets'].items():
+                    missed[target] = missed.get(target, 0) + count
+            else:
+                kept.append(entry)
+
+        if len(kept) + 1 >= len(self._outbox):
+            return False
+
+        frame = Frame({"type": "missed", "targets": missed})
+        kept.append((frame, frame.encode(self.codec), True))
+        self._outbox = kept
+        self.dropped += dropped
+        metrics.DROPPED.add(dropped, 'coalesce')
+        return True
 
     def broadcast(self, message):
-        for id_, session in sessions.items():
-            if id_ == self.id:
-                continue
-            self.logger.debug("Broadcasting msg to %s" % id_)
-            session.transport.write_json(message)
+        fanout(message, self.session)
 
-    def parse_line(self, data):
-        self.start_timer()
-        self.logger.debug(self._format_log("%s %r" % (ARROW_LEFT, data)))
+
+class RobustWebSocket(SessionProtocol, tornado.websocket.WebSocketHandler):
+    MAX_UNFLUSHED = 64
+
+    def check_origin(self, origin):
+        return True
+
+    def get_compression_options(self):
+        if not options.ws_compression:
+            return None
+        return {
+            "compression_level": options.ws_compression_level,
+            "mem_level": options.ws_compression_mem_level
+        }
+
+    def open(self):
+        self._unflushed = 0
+        self._read_resumed = None
+        self.init_protocol()
+
+        logger = ConnectionLogger(logging.getLogger('websocket'),
+                                  self.request.remote_ip, self.id)
+        logger.info("Connection made!")
+        self.logger = logger
+        
+        sessions[self.id] = Session(properties, self, logger, MESSAGES_DB)
+        self.session = sessions[self.id]
+
+        self.write_json(messages.create_welcome("Welcome to Robust alpha.\n\n" +
+                                                "This will be excellent."))
+
+
+    def on_message(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.feed(data)
+        # Tornado reads no further messages until this resolves.
+        return self._read_resumed
+
+    def pause_reading(self):
+        self._read_resumed = Future()
+
+    def resume_reading(self):
+        future, self._read_resumed = self._read_resumed, None
+        future.set_result(None)
+
+    def disconnect(self):
+        self.close()
+
+    def heartbeat(self):
+        # Browsers answer WebSocket pings by themselves.
         try:
-            # TODO see if yield can be used here
-            self.on_json(json.loads(data.decode('utf-8')))
-        except ValueError as e:
-            self.write_json(messages.create_error("parser", e))
-    
-    def _format_log(self, words):
-        #peername = "%s:%s" % self.transport.get_extra_info('peername')
-        return "%s (%s)" % (words, self.request.remote_ip)
+            self.ping(b'')
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_pong(self, data):
+        self.last_activity = time.monotonic()
+
+    def on_close(self):
+        self.logger.info("Connection lost!")
+        self.close_protocol()
+
+    def write_data(self, data):
+        try:
+            future = self.write_message(data, binary=self.codec.binary)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        metrics.BYTES_WRITTEN.add(len(data), 'websocket')
+
+        # Tornado's write futures stand in for asyncio's flow control.
+        if future is not None:
+            self._unflushed += 1
+            if self._unflushed >= self.MAX_UNFLUSHED:
+                self.pause_writing()
+            future.add_done_callback(self._on_flushed)
+
+    def _on_flushed(self, future):
+        if not future.cancelled():
+            future.exception()  # Closed streams are handled by on_close.
+        self._unflushed -= 1
+        if self._paused and self._unflushed <= self.MAX_UNFLUSHED // 4:
+            self.resume_writing()
+
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.REGISTRY.render())
 
 
 class TwitterLoginHandler(RequestHandler,
@@ -281,143 +682,166 @@ class TwitterLoginHandler(RequestHandler,
                                   response)
 
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, uuid.UUID):
-            return o.hex
-        if hasattr(o, '_to_json'):
-            return o._to_json()
-        return super().default(o)
+class Frame:
+    """A message serialized once per encoding, lazily, and written as the
+    same bytes to every transport using that encoding."""
+    __slots__ = ('message', '_encoded', '_text')
 
+    def __init__(self, message, data=None):
+        self.message = message
+        self._encoded = {} if data is None else {wire.JSON.name: data}
+        self._text = None
 
-sessions = {}
-
-
-class TCPServer(asyncio.Protocol):
-    FRAME_SIZE = 1024
-
-    def _heartbeat_failed(self, transport):
-        self.logger.warn(
-                self._format_log("No response in %s seconds, closing." % self.read_wait))
-        transport.close()
-
-    def heartbeat(self, transport):
-        self.write_json({"type": "ping"})
-
-        self._heartbeat_handle = transport._loop\
-                .call_later(self.read_wait, lambda: self._heartbeat_failed(transport))
+    def encode(self, codec):
+        data = self._encoded.get(codec.name)
+        if data is None:
+            data = self._encoded[codec.name] = codec.encode(self.message)
+        return data
 
-    def update_heartbeat_future(self, transport):
-        if self._heartbeat_handle is not None:
-            self._heartbeat_handle.cancel()
+    @property
+    def data(self):
+        return self.encode(wire.JSON)
 
-        self.logger.debug(self._format_log(
-            "Heartbeat set for %s seconds." % self.idle_wait))
+    @property
+    def text(self):
+        """Decoded form of `data` without the newline, for logging."""
+        if self._text is None:
+            self._text = self.data[:-1].decode('utf-8')
+        return self._text
 
-        self._heartbeat_handle = transport._loop\
-                .call_later(self.idle_wait, lambda: self.heartbeat(transport))
 
-    def _format_log(self, words):
-        peername = "%s:%s" % self.transport.get_extra_info('peername')
-        return "%s (%s)" % (words, peername)
+sessions = {}
+# Session ids, unique within this process; other workers and nodes know
+# sessions only by handle.
+SESSION_IDS = itertools.count(1)
+channels = ChannelIndex()
+# Links to other workers and nodes, see workers.py and cluster.py.
+RELAYS = []
+RELAY_LOGGER = logging.getLogger('bus')
+
+metrics.Gauge('robust_sessions', "Sessions open on this worker.",
+              lambda: len(sessions))
+metrics.Gauge('robust_mongo_connections_in_use', "MongoDB connections checked out.",
+              lambda: MONGO_POOL.stats.in_use)
+metrics.Gauge('robust_outbound_queued_frames',
+              "Frames queued for slow readers, across all sessions.",
+              lambda: sum(session.queue_depth for session in sessions.values()))
+metrics.Gauge('robust_write_behind_depth', "Messages queued to be written behind.",
+              lambda: MESSAGES_DB.writer.depth if MESSAGES_DB.writer is not None else 0)
+
+
+def fanout(message, origin):
+    """Writes `message` to the sessions subscribed to its target, other
+    than the `origin` session it came from, and relays it to other workers
+    and nodes."""
+    user = origin.user
+    handle = user['handle'] if user is not None else None
+
+    frame = Frame(message)
+    deliver(frame, handle, origin)
+
+    for relay in RELAYS:
+        relay.publish("message", message['target'], handle, frame.data)
+
+
+def deliver(frame, handle, origin=None):
+    """Writes `frame` to the local sessions subscribed to its target."""
+    logger = origin.logger if origin is not None else RELAY_LOGGER
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    written = 0
+    for id_ in tuple(channels.recipients(frame.message['target'], handle)):
+        if origin is not None and id_ == origin.id:
+            continue
+        session = sessions.get(id_)
+        if session is None:
+            continue
+        if debug:
+            logger.debug("Broadcasting msg to %s", id_)
+        session.transport.write_frame(frame, broadcast=True)
+        written += 1
+
+    metrics.RECIPIENTS.observe(written)
+
+
+def on_relay_event(kind, target, handle, body):
+    """Applies an event published by another worker or node to this one."""
+    if kind == "message":
+        message = json.loads(body[:-1].decode('utf-8'))
+        if not target.startswith("@"):
+            record = message.copy()
+            record.pop('original_body', None)
+            HISTORY.append(target, record)
+        deliver(Frame(message, body), handle)
+    elif kind == "join":
+        channels.join(handle, target)
+        USERS_DB.cache.forget('handle', handle)
+    elif kind == "part":
+        channels.part(handle, target)
+        USERS_DB.cache.forget('handle', handle)
+
+
+class TCPServer(SessionProtocol, asyncio.Protocol):
+    __slots__ = ('transport',)
 
-    def log_request(self, type_, ms):
-        self.logger.info("%s %.2fms" % (
-            self._format_log(type_.upper()), ms))
+    FRAME_SIZE = 1024
 
     def connection_made(self, transport):
         transport.set_write_buffer_limits(self.FRAME_SIZE, self.FRAME_SIZE // 8)
 
-        self._heartbeat_handle = None
-        self._buf = BytesIO()
-
-        self.idle_wait = 180
-        self.read_wait = 30
-
-        self.id = uuid.uuid4().hex
+        self.init_protocol()
         self.transport = transport
 
-        logger = logging.getLogger('socket')
-        logger.info(self._format_log("Connection made!"))
-        logger.debug(self._format_log("Using cipher: %s_%s_%s" %\
-                transport.get_extra_info('cipher')))
+        peer = "%s:%s" % transport.get_extra_info('peername')[:2]
+        logger = ConnectionLogger(logging.getLogger('socket'), peer, self.id)
+        logger.info("Connection made!")
+        logger.debug("Using cipher: %s_%s_%s", *transport.get_extra_info('cipher'))
         self.logger = logger
 
-        sessions[self.id] = Session(properties, self, logger, db.MessagesDB())
+        sessions[self.id] = Session(properties, self, logger, MESSAGES_DB)
         self.session = sessions[self.id]
 
-        self.message_handler = messages.SocketMessageHandler(self.session)
-
         self.write_json(messages.create_welcome("Welcome to Robust alpha.\n\n" +
-                                                "This will be excellent."))
-        self.update_heartbeat_future(self.transport)
+                                                "This will be excellent.",
+                                                self.compressions))
 
     def connection_lost(self, exc):
-        if self._heartbeat_handle is not None:
-            self._heartbeat_handle.cancel()
-        self.logger.info(self._format_log("Connection lost!"))
-        if sessions.get(self.id, None):
-            del sessions[self.id]
+        self.logger.info("Connection lost!")
+        self.close_protocol()
 
     def data_received(self, data):
-        i = data.find(b'\n')
-        while i > -1:
-            self._buf.write(data[:i])
-            self.parse_line(self._buf.getvalue())
-            self._buf = BytesIO()
-            data = data[i+1:]
-            i = data.find(b'\n')
-        self._buf.write(data)
+        self.feed(data)
 
-    def parse_line(self, data):
-        self.start_timer()
-        self.update_heartbeat_future(self.transport)
+    def disconnect(self):
+        self.transport.close()
 
-        self.logger.debug(self._format_log("%s %r" % (ARROW_LEFT, data)))
-        try:
-            # TODO see if yield can be used here
-            self.on_json(json.loads(data.decode('utf-8')))
-        except ValueError as e:
-            self.write_json(messages.create_error("parser", e))
+    def pause_reading(self):
+        self.transport.pause_reading()
 
-    def start_timer(self):
-        self._timer = time.time() * 1000
-
-    def stop_timer(self):
-        t = self._timer
-        self._timer = None
-        return time.time() * 1000 - t
+    def resume_reading(self):
+        self.transport.resume_reading()
 
-    def write_json(self, data):
-        out = json.dumps(data, cls=JSONEncoder, separators=(',', ':'))
-        self.logger.debug(self._format_log("%s %s" % (ARROW_RIGHT, out)))
-        self.transport.write(out.encode('utf-8') + b'\n')
+    def write_data(self, data):
+        if self._stream is not None:
+            data = self._stream.compress(data)
+        self.transport.write(data)
+        metrics.BYTES_WRITTEN.add(len(data), 'tcp')
 
-    def on_json(self, json_dict):
-        try:
-            msg = self.message_handler.parse(json_dict)
-            if msg is not None:
-                self.write_json(msg)
-            self.log_request(json_dict['type'], self.stop_timer())
-        except MessageError as e:
-            self.write_json(messages.create_error('message', e))
-        except NotAuthenticatedError as e:
-            self.write_json(messages.create_error('authentication', e))
-        except Exception as e:
-            self.write_json(messages.create_error('internal',
-                "An internal server error has occurred."))
-            raise e
+    @property
+    def compressions(self):
+        return (compression.ZlibStream.name,) if options.tcp_compression else ()
 
-    def broadcast(self, message):
-        for id_, session in sessions.items():
-            if id_ == self.id:
-                continue
-            self.logger.debug("Broadcasting msg to %s" % id_)
-            session.transport.write_json(message)
+    def set_compression(self, name):
+        if name not in self.compressions:
+            super().set_compression(name)
+        self._stream = compression.ZlibStream(options.tcp_compression_level,
+                                              options.tcp_compression_wbits,
+                                              options.tcp_compression_mem_level)
 
 def make_app():
     return Application([
             url(r'/auth/twitter', TwitterLoginHandler),
+            url(r'/metrics', MetricsHandler),
             url(r'/ws', RobustWebSocket)
         ],
         twitter_consumer_key=properties.twitter_key,
@@ -425,7 +849,7 @@ def make_app():
 
 
 def main():
-    global properties, MONGO_DB
+    global properties, MONGO_POOL, MONGO_DB, MESSAGES_DB, USERS_DB, HISTORY, HEARTBEATS
 
     tornado.options.parse_command_line()
 
@@ -436,10 +860,23 @@ def main():
     with open(options.config) as f:
         config = toml.load(f)
 
-    for k in ['http', 'tcp', 'certfile', 'keyfile']:
+    for k in ['http', 'tcp', 'mongo', 'mongo_pool_size', 'mongo_min_pool_size',
+              'mongo_wait_timeout', 'db_workers', 'idle_wait', 'read_wait',
+              'max_line', 'workers', 'ipc_dir', 'cluster', 'cluster_collection_size',
+              'ws_compression', 'ws_compression_level', 'ws_compression_mem_level',
+              'tcp_compression', 'tcp_compression_level', 'tcp_compression_wbits',
+              'tcp_compression_mem_level', 'certfile', 'keyfile']:
         if config.get(k, None):
             setattr(options, k, config[k])
 
+    node = cluster.node_id()
+    worker_id = None
+    if options.workers > 1 and not options.check_indexes:
+        # Fork before any event loop or MongoClient exists; the parent stays
+        # behind to restart workers that die.
+        ipc_dir = options.ipc_dir or tempfile.mkdtemp(prefix='robust-')
+        worker_id = tornado.process.fork_processes(options.workers)
+
     AsyncIOMainLoop().install()
 
     loop = asyncio.get_event_loop()
@@ -450,27 +887,93 @@ def main():
 
     properties = Properties(**config.get('properties', {}))
 
-    MONGO_DB = pymongo.MongoClient(mongo_host, int(mongo_port)).robust
+    MONGO_POOL = db.MongoPool(mongo_host, int(mongo_port),
+                              max_pool_size=options.mongo_pool_size,
+                              min_pool_size=options.mongo_min_pool_size,
+                              wait_queue_timeout=options.mongo_wait_timeout,
+                              workers=options.db_workers)
+    MONGO_DB = MONGO_POOL.database
+    MESSAGES_DB = db.MessagesDB(MONGO_DB, MONGO_POOL.executor,
+            batch_size=(properties.get('write_batch_size') or 100) if properties.get('write_behind') else None,
+            batch_delay=properties.get('write_batch_delay') or 0.05,
+            ack=properties.get('write_durability') != 'broadcast')
+    USERS_DB = db.UsersDB(MONGO_DB, MONGO_POOL.executor, db.UserCache(
+        properties.get('user_cache_size') or 10000,
+        properties.get('user_cache_ttl') or 300),
+        save_delay=properties.get('user_save_delay') or 0)
+    HISTORY = HistoryCache(properties.get('history_per_channel') or 200,
+                           properties.get('history_max_bytes') or 64 * 1024 * 1024)
     logger = logging.getLogger()
 
+    if options.indexes or options.check_indexes:
+        logger.info("Ensured indexes: %s." % ", ".join(db.ensure_indexes(MONGO_DB)))
+
+    if options.check_indexes:
+        unindexed = db.unindexed_queries(MONGO_DB)
+        for description, stages in unindexed:
+            logger.warning("Query '%s' is not using an index: %s." % (
+                description, " <- ".join(stages)))
+        if not unindexed:
+            logger.info("All hot queries are using an index.")
+        MONGO_POOL.close()
+        return
+
     # Bloody asyncio
     logging.getLogger('asyncio').setLevel(logging.WARNING)
+    log_listener = logs.start_queue_logging()
+
+    HEARTBEATS = heartbeat.HeartbeatWheel(options.idle_wait, options.read_wait)
+    tornado.ioloop.PeriodicCallback(HEARTBEATS.sweep,
+                                    HEARTBEATS.tick * 1000).start()
+
+    reuse_port = worker_id is not None
+    if reuse_port:
+        bus = workers.WorkerBus(ipc_dir, worker_id, options.workers, on_relay_event, loop)
+        bus.start()
+        RELAYS.append(bus)
+        logger.info("Worker %d of %d started." % (worker_id, options.workers))
+
+    if options.cluster:
+        fanout_ = cluster.ClusterFanout(MONGO_DB, node, on_relay_event, loop,
+                                        size=options.cluster_collection_size)
+        fanout_.start()
+        RELAYS.append(fanout_)
+        logger.info("Cluster fanout started as node %s." % node)
 
     app = make_app()
-    app.listen(int(http_port), http_host, xheaders=True)
+    if reuse_port:
+        http_server = tornado.httpserver.HTTPServer(app, xheaders=True)
+        http_server.add_sockets(tornado.netutil.bind_sockets(
+            int(http_port), http_host, reuse_port=True))
+    else:
+        app.listen(int(http_port), http_host, xheaders=True)
     logger.info("HTTP server listening on %s." % options.http)
 
     coro = loop.create_server(TCPServer, tcp_host, int(tcp_port),
-            ssl=create_ssl_context(options.certfile, options.keyfile))
+            ssl=create_ssl_context(options.certfile, options.keyfile),
+            reuse_port=reuse_port)
     tcp_server = loop.run_until_complete(coro)
     logger.info("TCP server listening on %s." % options.tcp)
 
+    # Supervisors stop workers with SIGTERM; stop the loop so that queued
+    # writes are flushed below.
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         pass
     finally:
         tcp_server.close()
+        for relay in RELAYS:
+            relay.close()
+        MESSAGES_DB.close()
+        USERS_DB.close()
+        if MESSAGES_DB.writer is not None:
+            logger.info("Write-behind: %r" % MESSAGES_DB.writer.as_dict())
+        logger.info("MongoDB pool: %r" % MONGO_POOL.stats.as_dict())
+        MONGO_POOL.close()
+        log_listener.stop()
         loop.close()
 
 if __name__ == "__main__":
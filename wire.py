@@ -0,0 +1,80 @@
+import json
+import struct
+import uuid
+
+from framing import LineFramer, LengthPrefixedFramer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# msgpack extension type carrying the 16 bytes of a UUID.
+EXT_UUID = 1
+
+
+class JSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, uuid.UUID):
+            return o.hex
+        if hasattr(o, '_to_json'):
+            return o._to_json()
+        return super().default(o)
+
+
+class JSONCodec:
+    """Newline delimited JSON, the default encoding."""
+    name = "json"
+    binary = False
+
+    def encode(self, message):
+        out = json.dumps(message, cls=JSONEncoder, separators=(',', ':'))
+        return out.encode('utf-8') + b'\n'
+
+    def decode(self, data):
+        return json.loads(data.decode('utf-8'))
+
+    def framer(self, max_size):
+        return LineFramer(max_size)
+
+
+class MsgPackCodec:
+    """MessagePack, each message prefixed by its length as a 4 byte big
+    endian unsigned int. UUIDs are sent as extension type `EXT_UUID`."""
+    name = "msgpack"
+    binary = True
+
+    _header = struct.Struct('>I')
+
+    def _default(self, o):
+        if isinstance(o, uuid.UUID):
+            return msgpack.ExtType(EXT_UUID, o.bytes)
+        if hasattr(o, '_to_json'):
+            return o._to_json()
+        raise TypeError("%r is not MessagePack serializable" % o)
+
+    def _ext_hook(self, code, data):
+        if code == EXT_UUID:
+            return uuid.UUID(bytes=data)
+        return msgpack.ExtType(code, data)
+
+    def encode(self, message):
+        out = msgpack.packb(message, default=self._default, use_bin_type=True)
+        return self._header.pack(len(out)) + out
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False)
+        except Exception as e:
+            raise ValueError("Invalid MessagePack: %s" % e)
+
+    def framer(self, max_size):
+        return LengthPrefixedFramer(max_size)
+
+
+JSON = JSONCodec()
+
+CODECS = {JSON.name: JSON}
+
+if msgpack is not None:
+    CODECS[MsgPackCodec.name] = MsgPackCodec()
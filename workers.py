@@ -0,0 +1,154 @@
+"""Relays broadcasts between the worker processes of one server.
+
+With `--workers N` the server forks N workers which each accept their share
+of connections on SO_REUSEPORT listeners, so a channel's members may be
+spread across every worker. Each worker listens on a Unix socket in a
+directory shared by all of them and sends each event to its peers, which
+then deliver it to their own sessions.
+"""
+from collections import deque
+
+import asyncio
+import json
+import logging
+import os
+import struct
+
+from framing import LengthPrefixedFramer
+
+# Events are broadcast messages, far smaller than this.
+MAX_EVENT = 16 * 1024 * 1024
+# Events held for a peer that hasn't been connected to yet.
+MAX_BACKLOG = 10000
+RECONNECT_DELAY = 0.5
+
+_header = struct.Struct('>I')
+
+
+def socket_path(ipc_dir, worker_id):
+    return os.path.join(ipc_dir, "worker-%d.sock" % worker_id)
+
+
+def encode_event(kind, target, handle, body=b''):
+    """Packs an event as its JSON header line followed by `body`."""
+    header = json.dumps({"kind": kind, "target": target, "handle": handle},
+                        separators=(',', ':')).encode('utf-8')
+    payload = header + b'\n' + body
+    return _header.pack(len(payload)) + payload
+
+
+def decode_event(payload):
+    header, _, body = payload.partition(b'\n')
+    header = json.loads(header.decode('utf-8'))
+    return header['kind'], header['target'], header['handle'], body
+
+
+class _BusProtocol(asyncio.Protocol):
+    def __init__(self, bus):
+        self.bus = bus
+        self.transport = None
+        self._framer = LengthPrefixedFramer(MAX_EVENT)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        for payload in self._framer.feed(data):
+            try:
+                self.bus.receive(*decode_event(payload))
+            except Exception:
+                self.bus.logger.exception("Failed to handle bus event.")
+
+
+class _Peer:
+    __slots__ = ('worker_id', 'transport', 'backlog', 'connecting')
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.transport = None
+        self.backlog = deque(maxlen=MAX_BACKLOG)
+        self.connecting = False
+
+
+class WorkerBus:
+    """The link from one worker to all its siblings.
+
+    `handler(kind, target, handle, body)` is called for every event another
+    worker publishes.
+    """
+
+    def __init__(self, ipc_dir, worker_id, count, handler, loop=None):
+        self.ipc_dir = ipc_dir
+        self.worker_id = worker_id
+        self.handler = handler
+        self.loop = loop or asyncio.get_event_loop()
+        self.logger = logging.getLogger('bus')
+
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+
+        self._server = None
+        self._peers = [_Peer(i) for i in range(count) if i != worker_id]
+
+    def start(self):
+        """Starts listening for peers, before the loop runs, and connects
+        to them."""
+        path = socket_path(self.ipc_dir, self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by a worker that was restarted.
+
+        self._server = self.loop.run_until_complete(
+            self.loop.create_unix_server(lambda: _BusProtocol(self), path))
+
+        for peer in self._peers:
+            self._connect(peer)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for peer in self._peers:
+            if peer.transport is not None:
+                peer.transport.close()
+
+    def publish(self, kind, target, handle, body=b''):
+        event = encode_event(kind, target, handle, body)
+
+        for peer in self._peers:
+            if peer.transport is not None and not peer.transport.is_closing():
+                peer.transport.write(event)
+                self.sent += 1
+            else:
+                if len(peer.backlog) == peer.backlog.maxlen:
+                    self.dropped += 1
+                peer.backlog.append(event)
+                self._connect(peer)
+
+    def receive(self, kind, target, handle, body):
+        self.received += 1
+        self.handler(kind, target, handle, body)
+
+    def _connect(self, peer):
+        if peer.connecting:
+            return
+        peer.connecting = True
+
+        future = self.loop.create_task(self.loop.create_unix_connection(
+            lambda: _BusProtocol(self),
+            socket_path(self.ipc_dir, peer.worker_id)))
+        future.add_done_callback(lambda f: self._on_connected(peer, f))
+
+    def _on_connected(self, peer, future):
+        peer.connecting = False
+
+        if future.cancelled() or future.exception() is not None:
+            # The peer may still be starting up; try again shortly.
+            self.loop.call_later(RECONNECT_DELAY, self._connect, peer)
+            return
+
+        peer.transport, _ = future.result()
+        while peer.backlog:
+            peer.transport.write(peer.backlog.popleft())
+            self.sent += 1
+
+        self.logger.debug("Connected to worker %d." % peer.worker_id)